@@ -0,0 +1,141 @@
+# Single-file model artifact.
+#
+# One safetensors file holds the weights of a trained network, the optional PCA projection of its
+# input, and in its header a JSON config with everything needed to use it: network class and
+# hyperparameters, embedding, keep_energy and esm_1b_separated. The weights are memory-mapped and
+# assigned to a network built on the meta device, so loading takes little more than importing torch.
+#
+#   python artifact.py convert --checkpoint checkpoint.pt --model Net_project --embedding esm-1b \
+#                              --output net_project_esm-1b.safetensors
+#   python artifact.py info net_project_esm-1b.safetensors
+#
+# needs: pip install safetensors
+
+import json
+import time
+import argparse
+import numpy as np
+import torch
+
+from model import build_model, infer_hyperparameters, Net
+
+format_version = 1
+
+
+def save_artifact(path, net, modelName, embedding, keep_energy, esm_1b_separated=False, pca=None):
+    """
+    Write a network and its settings to one safetensors file. pca is a fitted projection with
+    components_ (k, d) and mean_ (d,) like sklearn's PCA, applied to the input features.
+    """
+    from safetensors.torch import save_file
+    state_dict = net.state_dict()
+    config = {'format_version': format_version,
+              'modelName': modelName,
+              'hyperparameters': {key: (int(value) if value is not None else None)
+                                  for key, value in infer_hyperparameters(state_dict).items()},
+              'embedding': embedding,
+              'keep_energy': bool(keep_energy),
+              'esm_1b_separated': bool(esm_1b_separated),
+              'pca': None}
+    tensors = {'model.' + key: value.detach().contiguous() for key, value in state_dict.items()}
+    if pca is not None:
+        tensors['pca.components'] = torch.as_tensor(np.ascontiguousarray(pca.components_, dtype=np.float32))
+        tensors['pca.mean'] = torch.as_tensor(np.ascontiguousarray(pca.mean_, dtype=np.float32))
+        config['pca'] = {'n_components': int(pca.components_.shape[0]),
+                         'input_features': int(pca.components_.shape[1]),
+                         'zero_padding': bool(getattr(pca, 'zero_padding', False))}
+    save_file(tensors, path, metadata={'config': json.dumps(config)})
+    return config
+
+def read_config(path):
+    """
+    Config of an artifact, read from the file header only.
+    """
+    from safetensors import safe_open
+    with safe_open(path, framework='pt') as f:
+        return json.loads(f.metadata()['config'])
+
+class Pipeline:
+    """
+    A loaded artifact. predict_proba takes complexes in the (n, residues, features) layout of
+    the data files (after embedding, before PCA) and returns probabilities.
+    """
+    def __init__(self, net, config):
+        self.net = net.eval()
+        self.config = config
+        self.outputs_probabilities = isinstance(net, Net)
+
+    def predict_proba(self, x):
+        with torch.no_grad():
+            x = torch.as_tensor(np.asarray(x, dtype=np.float32))
+            output = self.net(x.transpose(2, 1).contiguous())
+            if not self.outputs_probabilities:
+                output = torch.sigmoid(output)
+        return output.numpy().ravel()
+
+def load_artifact(path):
+    """
+    Memory-map an artifact and rebuild its network without initializing any weights.
+    """
+    from safetensors.torch import load_file
+    config = read_config(path)
+    if config['format_version'] > format_version:
+        raise ValueError("{} has format version {}, this code reads up to {}".format(
+            path, config['format_version'], format_version))
+    tensors = load_file(path)
+    state_dict = {key[len('model.'):]: value for key, value in tensors.items() if key.startswith('model.')}
+
+    hp = config['hyperparameters']
+    with torch.device('meta'):
+        net = build_model(config['modelName'], hp['n_features'], hp['numHN'], hp['numFilter'], 0.0)
+    net.load_state_dict(state_dict, assign=True)
+    if config['pca'] is not None:
+        # the projection becomes part of the first layer, the pipeline takes the raw features
+        from projection import fold_pca
+        fold_pca(net, tensors['pca.components'], tensors['pca.mean'], config['pca']['zero_padding'])
+    return Pipeline(net, config)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create or inspect single-file model artifacts.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    convert = commands.add_parser('convert', help="bundle a checkpoint with its settings")
+    convert.add_argument('--checkpoint', required=True, help="state dict saved during training")
+    convert.add_argument('--model', default="Net_project", help="network class in model.py")
+    convert.add_argument('--embedding', default="Baseline", help="Baseline, esm-1b or esm_ASM")
+    convert.add_argument('--no-energy', action='store_true', help="the network was trained without energy terms")
+    convert.add_argument('--separated', action='store_true', help="the network was trained on esm_1b_separated inputs")
+    convert.add_argument('--pca', help="projection saved by projection.py (.npz) or a pickled fitted PCA")
+    convert.add_argument('--output', required=True, help=".safetensors file")
+
+    info = commands.add_parser('info', help="print the config of an artifact and time its cold start")
+    info.add_argument('artifact')
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        from model import load_checkpoint
+        net = load_checkpoint(args.checkpoint, args.model)
+        pca = None
+        if args.pca and args.pca.endswith('.npz'):
+            from projection import load_pca
+            pca = load_pca(args.pca)
+        elif args.pca:
+            import pickle
+            with open(args.pca, 'rb') as f:
+                pca = pickle.load(f)
+        config = save_artifact(args.output, net, args.model, args.embedding, not args.no_energy, args.separated, pca)
+        print("Wrote", args.output)
+        print(json.dumps(config, indent=2))
+    else:
+        start = time.perf_counter()
+        pipeline = load_artifact(args.artifact)
+        loaded = time.perf_counter() - start
+        n_features = pipeline.config['pca']['input_features'] if pipeline.config['pca'] else pipeline.config['hyperparameters']['n_features']
+        pipeline.predict_proba(np.zeros((1, 420, n_features), dtype=np.float32))
+        first = time.perf_counter() - start
+        print(json.dumps(pipeline.config, indent=2))
+        print("Loaded in {:.3f} s, first prediction after {:.3f} s".format(loaded, first))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# Asynchronous successive halving (ASHA) on top of the grid executor.
+#
+# Rungs are placed at min_epochs * eta^k epochs. When a configuration reaches a rung, its
+# validation AUC is compared with the AUCs every other configuration had at that rung so far;
+# only the top 1/eta keep training, the others are stopped. Decisions never wait for the
+# rest of the grid, so the process pool stays busy.
+
+import os
+import time
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import functions as func
+import grid
+from run_index import asha_status_tag
+
+
+def stopped_experiment(name_experiment):
+    """
+    mlflow experiment of the trials ASHA stopped at a rung, kept apart from the fully trained ones
+    since their test metrics come from partially trained networks.
+    """
+    return name_experiment + ' (stopped by ASHA)'
+
+def make_rungs(min_epochs, eta, max_epochs):
+    """
+    Epochs at which configurations are compared, e.g. 5, 15, 45 for min_epochs=5, eta=3, max_epochs=100.
+    """
+    rungs = []
+    rung = min_epochs
+    while rung < max_epochs:
+        rungs.append(rung)
+        rung *= eta
+    return rungs
+
+class RungCallback:
+    """
+    Epoch callback of one configuration for functions.train_project. The validation AUCs
+    of all configurations live in a multiprocessing manager dict shared by the pool workers.
+    """
+    def __init__(self, rungs, records, lock, eta):
+        self.rungs = rungs
+        self.records = records
+        self.lock = lock
+        self.eta = eta
+        self.stopped_at = None
+
+    def __call__(self, epoch, valid_auc):
+        epochs_done = epoch + 1
+        if epochs_done not in self.rungs:
+            return False
+
+        with self.lock:
+            recorded = self.records.get(epochs_done, []) + [valid_auc]
+            self.records[epochs_done] = recorded   # reassign, manager dicts do not see in-place changes
+
+        # the first configuration at a rung always continues
+        cutoff = np.percentile(recorded, 100 * (1 - 1 / self.eta))
+        if valid_auc < cutoff:
+            self.stopped_at = epochs_done
+            return True
+        return False
+
+def train_trial(store_dir, config, rungs, records, lock, eta):
+    """
+    Train one configuration in a pool worker until it finishes, early stops or loses at a rung.
+    """
+    start = time.time()
+    X, y, offsets = grid.open_store(store_dir)
+    callback = RungCallback(rungs, records, lock, eta)
+    result = func.train_on_store(X, y, offsets, config, epoch_callback=callback)
+    result['stopped at rung'] = callback.stopped_at
+    result['minutes'] = (time.time() - start) / 60
+    return result
+
+def run_asha(configs, min_epochs=5, eta=3, n_workers=None, threads_per_worker=2, name_experiment=None,
+             store_root='../data/partitionStore/'):
+    """
+    Run a grid with ASHA early stopping. Returns the results of every configuration
+    (best validation AUC first) and a report of the epochs and time spent versus the full grid.
+    """
+    if n_workers is None:
+        n_workers = max(1, os.cpu_count() // threads_per_worker)
+
+    tasks = grid.prepare_tasks(configs, store_root)
+    max_epochs = tasks[0][1]['epochs']
+    rungs = make_rungs(min_epochs, eta, max_epochs)
+    print("Rungs at epochs", rungs)
+
+    rows = []
+    start = time.time()
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Manager() as manager:
+        records = manager.dict()
+        lock = manager.Lock()
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=ctx,
+                                 initializer=grid.init_worker,
+                                 initargs=(threads_per_worker,)) as pool:
+            futures = {pool.submit(train_trial, store_dir, run_config, rungs, records, lock, eta): run_config
+                       for store_dir, run_config in tasks}
+            for future in as_completed(futures):
+                run_config = futures[future]
+                result = future.result()
+                if name_experiment:
+                    # stopped trials are logged too, to their own experiment, so a rerun does not train them again
+                    stopped = result['stopped at rung'] is not None
+                    grid.log_mlflow(run_config, result, stopped_experiment(name_experiment) if stopped else name_experiment,
+                                    tags={asha_status_tag: 'stopped' if stopped else 'completed'},
+                                    metrics={'stopped at rung': result['stopped at rung']} if stopped else None)
+
+                row = {key: run_config[key] for key in ['embedding', 'esm_1b_separated', 'modelName', 'numHN',
+                                                        'numFilter', 'dropOutRate', 'learning_rate', 'weight_decay']}
+                row.update(result)
+                rows.append(row)
+                print("Done {}/{} in {} mins, {} epochs, stopped at rung {}".format(
+                    len(rows), len(tasks), round((time.time()-start)/60, 2), result['epochs'], result['stopped at rung']))
+
+    results = pd.DataFrame(rows).sort_values(by='valid AUC', ascending=False).reset_index(drop=True)
+
+    # the full grid would train every configuration for up to max_epochs (patience can stop it earlier)
+    epochs_run = int(results['epochs'].sum())
+    epochs_full = max_epochs * len(results)
+    minutes_per_epoch = results['minutes'].sum() / epochs_run
+    report = {'configurations': len(results),
+              'stopped by ASHA': int(results['stopped at rung'].notna().sum()),
+              'epochs run': epochs_run,
+              'epochs full grid': epochs_full,
+              'compute saved': 1 - epochs_run / epochs_full,
+              'worker minutes': results['minutes'].sum(),
+              'estimated worker minutes full grid': minutes_per_epoch * epochs_full,
+              'wall minutes': (time.time() - start) / 60}
+    return results, report
@@ -0,0 +1,130 @@
+# Cascade inference: the Baseline network scores every complex on its raw 54 features, and only the
+# complexes whose probability falls in an uncertainty band are embedded with ESM and rescored by the
+# stronger network.
+#
+#   python cascade.py --baseline baseline.pt --strong esm.pt --strong-model Net_project \
+#                     --embedding esm-1b --band 0.2 0.8
+#
+# For the evaluation on the held-out partition the ESM input of the routed complexes comes from the
+# partition store, so the strong network can also be scored on every complex for comparison.
+
+import argparse
+import numpy as np
+import pandas as pd
+
+import functions as func
+from model import load_checkpoint
+from predict import TorchBackend, featurize
+
+
+class Cascade:
+    """
+    Two-stage predictor. baseline_fn and strong_fn map model input to probabilities; complexes
+    with a baseline probability in [low, high] are rescored with strong_fn.
+    """
+    def __init__(self, baseline_fn, strong_fn, low=0.2, high=0.8):
+        if not 0 <= low <= high <= 1:
+            raise ValueError("The uncertainty band must satisfy 0 <= low <= high <= 1")
+        self.baseline_fn = baseline_fn
+        self.strong_fn = strong_fn
+        self.low = low
+        self.high = high
+        self.n_scored = 0
+        self.n_routed = 0
+
+    def baseline_proba(self, complexes, chunk_size=256):
+        """
+        Baseline probabilities of raw complexes (n, 420, 54), chunk_size complexes at a time.
+        """
+        return np.concatenate([self.baseline_fn(complexes[start:start+chunk_size])
+                               for start in range(0, len(complexes), chunk_size)])
+
+    def predict_proba(self, complexes, strong_input_fn, chunk_size=256, baseline_probs=None):
+        """
+        Probabilities of raw complexes (n, 420, 54) and a mask of the ones that were routed.
+        strong_input_fn maps indices into complexes to the input of the strong network.
+        baseline_probs, if already computed with baseline_proba, saves the baseline pass.
+        """
+        if baseline_probs is None:
+            baseline_probs = self.baseline_proba(complexes, chunk_size)
+        probs = np.array(baseline_probs, copy=True)
+        routed = (probs >= self.low) & (probs <= self.high)
+        indices = np.flatnonzero(routed)
+        for start in range(0, len(indices), chunk_size):
+            chunk = indices[start:start+chunk_size]
+            probs[chunk] = self.strong_fn(strong_input_fn(chunk))
+        self.n_scored += len(complexes)
+        self.n_routed += len(indices)
+        return probs, routed
+
+    def routed_fraction(self):
+        return self.n_routed / self.n_scored if self.n_scored else float('nan')
+
+def embedding_input_fn(complexes, embedding, keep_energy):
+    """
+    strong_input_fn embedding the routed complexes with ESM, for data without a partition store.
+    """
+    return lambda indices: featurize(complexes[indices], embedding, keep_energy)
+
+def sweep_bands(baseline_probs, strong_probs, targets, bands):
+    """
+    Routed fraction and AUC of the cascade for several uncertainty bands, from the baseline and
+    strong probabilities of every complex. AUC retained is relative to the strong network alone.
+    """
+    strong_auc = func.classification_metrics(targets, strong_probs)['AUC']
+    rows = []
+    for low, high in bands:
+        routed = (baseline_probs >= low) & (baseline_probs <= high)
+        probs = np.where(routed, strong_probs, baseline_probs)
+        metrics = func.classification_metrics(targets, probs)
+        rows.append({'low': low, 'high': high, 'routed fraction': routed.mean(),
+                     'AUC': metrics['AUC'], 'MCC': metrics['MCC'], 'AUC retained': metrics['AUC'] / strong_auc})
+    return pd.DataFrame(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Baseline-then-ESM cascade on the held-out partition.")
+    parser.add_argument('--baseline', required=True, help="checkpoint of the network trained on the Baseline features")
+    parser.add_argument('--baseline-model', default="Net_project")
+    parser.add_argument('--strong', required=True, help="checkpoint of the network trained on ESM embeddings")
+    parser.add_argument('--strong-model', default="Net_project")
+    parser.add_argument('--embedding', default="esm-1b", help="embedding of the strong network")
+    parser.add_argument('--no-energy', action='store_true', help="the strong network was trained without energy terms")
+    parser.add_argument('--separated', action='store_true', help="the strong network was trained on esm_1b_separated inputs")
+    parser.add_argument('--band', type=float, nargs=2, default=[0.2, 0.8], metavar=('LOW', 'HIGH'))
+    parser.add_argument('--test', type=int, nargs='+', default=func.default_config['test_partitions'], help="held-out partitions")
+    parser.add_argument('--sweep', action='store_true', help="also report a range of bands")
+    parser.add_argument('--chunk-size', type=int, default=256, help="complexes scored per batch")
+    args = parser.parse_args(argv)
+
+    baseline = TorchBackend(load_checkpoint(args.baseline, args.baseline_model))
+    strong = TorchBackend(load_checkpoint(args.strong, args.strong_model))
+
+    X_raw, y, offsets = func.load_partition_store(func.partition_store("Baseline", True))
+    X_emb, _, _ = func.load_partition_store(func.partition_store(args.embedding, not args.no_energy, args.separated))
+    indices = np.concatenate([np.arange(offsets[p], offsets[p+1]) for p in args.test])
+    complexes, targets = X_raw[indices], y[indices]
+
+    cascade = Cascade(baseline.predict_proba, strong.predict_proba, *args.band)
+    # the baseline pass is shared by the cascade and the baseline-only comparison
+    baseline_probs = cascade.baseline_proba(complexes, args.chunk_size)
+    probs, _ = cascade.predict_proba(complexes, lambda chunk: X_emb[indices[chunk]], args.chunk_size, baseline_probs)
+    metrics = func.classification_metrics(targets, probs)
+
+    strong_probs = np.concatenate([strong.predict_proba(X_emb[indices[start:start+args.chunk_size]])
+                                   for start in range(0, len(indices), args.chunk_size)])
+    baseline_auc = func.classification_metrics(targets, baseline_probs)['AUC']
+    strong_auc = func.classification_metrics(targets, strong_probs)['AUC']
+
+    print("Baseline only: AUC {:.4f}".format(baseline_auc))
+    print("{} only: AUC {:.4f}".format(args.embedding, strong_auc))
+    print("Cascade [{}, {}]: AUC {:.4f}, MCC {:.4f}, {:.1%} of {} complexes routed, {:.1%} of the AUC retained".format(
+        args.band[0], args.band[1], metrics['AUC'], metrics['MCC'], cascade.routed_fraction(), len(targets),
+        metrics['AUC'] / strong_auc))
+
+    if args.sweep:
+        bands = [(0.5 - w, 0.5 + w) for w in [0.05, 0.1, 0.2, 0.3, 0.4, 0.5]]
+        print(sweep_bands(baseline_probs, strong_probs, targets, bands).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# k-fold cross-validation over the data partitions.
+#
+# Each fold rotates which partitions are used for training, validation and test. The folds
+# are trained concurrently in a process pool whose workers memory-map one read-only
+# partition store (see functions.save_partition_store) instead of reloading the data.
+
+import os
+import time
+import multiprocessing
+import pandas as pd
+import torch
+from concurrent.futures import ProcessPoolExecutor
+
+import functions as func
+
+
+# memory-mapped partition store of the current worker process, opened once by init_worker
+store = {}
+
+def init_worker(store_dir, threads):
+    """
+    Pin the torch threads of a pool worker and open the shared partition store.
+    """
+    torch.set_num_threads(threads)
+    store['X'], store['y'], store['offsets'] = func.load_partition_store(store_dir)
+
+def make_folds(n_partitions=5):
+    """
+    Fold k tests on partition (k-1) mod n, validates on the partition before it and trains
+    on the rest, so fold 0 is the split of main3.ipynb (train 0-2, valid 3, test 4).
+    """
+    folds = []
+    for k in range(n_partitions):
+        test = (n_partitions - 1 + k) % n_partitions
+        valid = (n_partitions - 2 + k) % n_partitions
+        folds.append({'fold': k,
+                      'train_partitions': [p for p in range(n_partitions) if p not in (test, valid)],
+                      'valid_partitions': [valid],
+                      'test_partitions': [test]})
+    return folds
+
+def train_fold(fold, config):
+    """
+    Train and test one fold in a pool worker.
+    """
+    start = time.time()
+    fold_config = dict(config)
+    fold_config.update({key: fold[key] for key in ('train_partitions', 'valid_partitions', 'test_partitions')})
+    if config.get('checkpoint'):
+        fold_config['checkpoint'] = '{}_fold_{}.pt'.format(os.path.splitext(config['checkpoint'])[0], fold['fold'])
+
+    result = {'fold': fold['fold'],
+              'train partitions': fold['train_partitions'],
+              'valid partition': fold['valid_partitions'][0],
+              'test partition': fold['test_partitions'][0]}
+    result.update(func.train_on_store(store['X'], store['y'], store['offsets'], fold_config))
+    result['minutes'] = (time.time() - start) / 60
+    return result
+
+def cross_validate(store_dir, config=None, n_workers=None, threads_per_worker=None):
+    """
+    Train all folds of a partition store concurrently. Returns the per-fold
+    results and their mean and standard deviation.
+    """
+    run_config = dict(func.default_config)
+    run_config.update(config or {})
+
+    offsets = func.load_partition_store(store_dir)[2]
+    folds = make_folds(len(offsets) - 1)
+    if n_workers is None:
+        n_workers = min(len(folds), os.cpu_count())
+    if threads_per_worker is None:
+        threads_per_worker = max(1, os.cpu_count() // n_workers)
+
+    # spawn, since forking a process that already started torch's thread pools can deadlock
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(store_dir, threads_per_worker)) as pool:
+        results = list(pool.map(train_fold, folds, [run_config] * len(folds)))
+
+    results = pd.DataFrame(results)
+    summary = results[['epochs', 'train AUC', 'valid AUC', 'test AUC', 'test MCC', 'test ACC']].agg(['mean', 'std'])
+    return results, summary
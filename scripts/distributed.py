@@ -0,0 +1,188 @@
+# Data-parallel training of the networks in model.py over several local CPU processes
+# (torch.distributed with the gloo backend + DistributedDataParallel).
+#
+# The training partitions are sharded across the workers, every worker reads the same
+# memory-mapped partition store (see functions.save_partition_store) and the validation
+# metrics used for early stopping are all-reduced, so every rank stops at the same epoch.
+
+import os
+import time
+import socket
+import pickle
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
+from sklearn.metrics import accuracy_score, roc_auc_score
+
+import functions as func
+from model import build_model
+
+
+def free_port():
+    """
+    Ask the OS for a free TCP port for the process group rendezvous.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def all_reduce_sum(values):
+    """
+    Sum a list of numbers over all ranks.
+    """
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+def reduce_metrics(loss_sum, probs, targs):
+    """
+    Combine the local loss sum and predictions of every rank into global loss, AUC and ACC.
+    """
+    probs = np.concatenate(probs) if len(probs) else np.empty(0, dtype=np.float32)
+    targs = np.concatenate(targs) if len(targs) else np.empty(0, dtype=np.float32)
+    loss_sum, n = all_reduce_sum([loss_sum, len(probs)])
+
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, (probs, targs))
+    probs = np.concatenate([g[0] for g in gathered])
+    targs = np.concatenate([g[1] for g in gathered])
+
+    return loss_sum / n, roc_auc_score(targs, probs), accuracy_score(targs, np.round(probs)), probs, targs
+
+def evaluate(net, ldr, criterion):
+    """
+    Local pass over this rank's shard of a validation/test set.
+    """
+    net.eval()
+    loss_sum, probs, targs = 0.0, [], []
+    with torch.no_grad():
+        for data, target in ldr:
+            target_batch = target.float().unsqueeze(1)
+            output = net(data.float())
+            loss_sum += criterion(output, target_batch).item() * len(target)
+            probs.append(torch.sigmoid(output).numpy().ravel())
+            targs.append(target.float().numpy())
+    return loss_sum, probs, targs
+
+def shard(dataset, rank, world_size):
+    """
+    Strided shard of an evaluation set. Unlike DistributedSampler it does not pad with
+    repeated complexes, so the gathered predictions are exactly the original set.
+    """
+    return torch.utils.data.Subset(dataset, list(range(rank, len(dataset), world_size)))
+
+def worker(rank, world_size, store_dir, config, result_path, port, threads):
+    """
+    Training loop of one rank, following functions.train_project.
+    """
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.set_num_threads(threads)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.manual_seed(42)
+
+    X, y, offsets = func.load_partition_store(store_dir)
+    train_ds = func.PartitionDataset(X, y, offsets, config['train_partitions'])
+    val_ds = shard(func.PartitionDataset(X, y, offsets, config['valid_partitions']), rank, world_size)
+    test_ds = shard(func.PartitionDataset(X, y, offsets, config['test_partitions']), rank, world_size)
+
+    # bat_size is the global batch size, so runs with different numbers of workers take the same optimizer steps
+    sampler = DistributedSampler(train_ds, num_replicas=world_size, rank=rank, shuffle=True, seed=42)
+    train_ldr = torch.utils.data.DataLoader(train_ds, batch_size=max(1, config['bat_size'] // world_size), sampler=sampler)
+    val_ldr = torch.utils.data.DataLoader(val_ds, batch_size=config['bat_size'])
+    test_ldr = torch.utils.data.DataLoader(test_ds, batch_size=config['bat_size'])
+
+    net = build_model(config['modelName'], X.shape[2], config['numHN'], config['numFilter'], config['dropOutRate'])
+    ddp_net = DDP(net)
+    optimizer = optim.Adam(ddp_net.parameters(), lr=config['learning_rate'],
+                           weight_decay=config['weight_decay'],
+                           amsgrad=True,)
+    criterion = nn.BCEWithLogitsLoss()
+
+    history = {'train_losses': [], 'train_auc': [], 'train_acc': [],
+               'valid_losses': [], 'valid_auc': [], 'valid_acc': [],
+               'epoch_times': []}
+    no_epoch_improve = 0
+    min_val_loss = np.Inf
+
+    for epoch in range(config['epochs']):
+        start = time.time()
+        sampler.set_epoch(epoch)
+
+        # Train
+        ddp_net.train()
+        loss_sum, probs, targs = 0.0, [], []
+        for data, target in train_ldr:
+            target_batch = target.float().unsqueeze(1)
+
+            optimizer.zero_grad()
+            output = ddp_net(data.float())
+            batch_loss = criterion(output, target_batch)
+            batch_loss.backward()
+            optimizer.step()
+
+            loss_sum += batch_loss.item() * len(target)
+            probs.append(torch.sigmoid(output.detach()).numpy().ravel())
+            targs.append(target.float().numpy())
+        train_loss, train_auc, train_acc, _, _ = reduce_metrics(loss_sum, probs, targs)
+
+        # Validation, on the plain module so that no collective runs inside the (uneven) shards
+        val_loss, val_auc, val_acc, _, _ = reduce_metrics(*evaluate(net, val_ldr, criterion))
+
+        history['train_losses'].append(train_loss)
+        history['train_auc'].append(train_auc)
+        history['train_acc'].append(train_acc)
+        history['valid_losses'].append(val_loss)
+        history['valid_auc'].append(val_auc)
+        history['valid_acc'].append(val_acc)
+        history['epoch_times'].append(time.time() - start)
+
+        # Early stopping, identical on every rank since it only uses reduced values
+        if val_loss < min_val_loss:
+            no_epoch_improve = 0
+            min_val_loss = val_loss
+            if rank == 0 and config.get('checkpoint'):
+                torch.save(net.state_dict(), config['checkpoint'])
+        else:
+            no_epoch_improve += 1
+        if no_epoch_improve == config['patience']:
+            if rank == 0:
+                print("Early stopping\n")
+            break
+
+        if rank == 0 and epoch % 5 == 0:
+            print("Epoch {}".format(epoch),
+                  " \t Train loss: {:.5f} \t Validation loss: {:.5f}".format(train_loss, val_loss))
+
+    # Test
+    test_loss, test_auc, test_acc, test_probs, test_targs = reduce_metrics(*evaluate(net, test_ldr, criterion))
+    history.update({'test_loss': test_loss, 'test_auc': test_auc, 'test_acc': test_acc,
+                    'test_probs': test_probs, 'test_targs': test_targs,
+                    'n_train': len(train_ds), 'world_size': world_size})
+
+    if rank == 0:
+        with open(result_path, 'wb') as f:
+            pickle.dump(history, f)
+    dist.destroy_process_group()
+
+def train_distributed(store_dir, config=None, world_size=2, threads_per_worker=None, result_path='distributed_history.pkl'):
+    """
+    Train one configuration with world_size local processes and return the training history
+    of rank 0 (per-epoch losses/AUC/ACC, epoch times and test metrics).
+    """
+    run_config = dict(func.default_config)
+    run_config.update(config or {})
+    if threads_per_worker is None:
+        threads_per_worker = max(1, os.cpu_count() // world_size)
+
+    mp.spawn(worker,
+             args=(world_size, store_dir, run_config, result_path, free_port(), threads_per_worker),
+             nprocs=world_size,
+             join=True)
+    with open(result_path, 'rb') as f:
+        return pickle.load(f)
@@ -6,6 +6,7 @@ import numpy as np
 import torch, sys
 import esm
 import gc
+import threading
 
 
 def esm_1b_peptide(peptide, pooling=False):
@@ -118,6 +119,66 @@ def esm_ASM(peptide, pooling=False):
     return sequence_representations
 
 
+
+# ESM models loaded by load_esm, kept for the lifetime of the process
+esm_models = {}
+# concurrent first calls (e.g. server.py's handler threads) load a model only once
+esm_lock = threading.Lock()
+
+def load_esm(embedding):
+    """
+    Load the ESM model of an embedding once per process: (model, alphabet, representation layer).
+    """
+    with esm_lock:
+        if embedding not in esm_models:
+            if embedding == "esm-1b":
+                model, alphabet = esm.pretrained.esm1b_t33_650M_UR50S()
+                layer = 33
+            elif embedding == "esm_ASM":
+                model, alphabet = esm.pretrained.esm_msa1b_t12_100M_UR50S()
+                layer = 12
+            else:
+                raise ValueError("No ESM model for embedding {}".format(embedding))
+            model.eval()
+            esm_models[embedding] = (model, alphabet, layer)
+        return esm_models[embedding]
+
+def embed_sequences(sequences, embedding, batch_size=8, pad_to=420, return_contacts=False):
+    """
+    Per-residue embeddings of many sequences, padded to pad_to rows like esm_1b_peptide and esm_ASM,
+    but with the model loaded once and run on batches of sequences.
+    With return_contacts, also the (length x length) contact probabilities of every sequence
+    from the same forward pass.
+    """
+    model, alphabet, layer = load_esm(embedding)
+    batch_converter = alphabet.get_batch_converter()
+
+    embedded, contacts = [], []
+    for start in range(0, len(sequences), batch_size):
+        batch = sequences[start:start+batch_size]
+        if embedding == "esm_ASM":
+            # every sequence is its own single-row alignment
+            _, _, batch_tokens = batch_converter([[("", seq)] for seq in batch])
+        else:
+            _, _, batch_tokens = batch_converter([("", seq) for seq in batch])
+        with torch.no_grad():
+            results = model(batch_tokens, repr_layers=[layer], return_contacts=return_contacts)
+        token_representations = results["representations"][layer].numpy()
+        if embedding == "esm_ASM":
+            token_representations = token_representations[:, 0]
+
+        for i, seq in enumerate(batch):
+            trp = token_representations[i, 1: len(seq) + 1]
+            if pad_to is not None:
+                trp = np.pad(trp, ((0, pad_to - trp.shape[0]), (0, 0)), 'constant')
+            embedded.append(trp)
+            if return_contacts:
+                # the contact head already drops the start and end tokens
+                contacts.append(results["contacts"][i, :len(seq), :len(seq)].numpy())
+    if return_contacts:
+        return embedded, contacts
+    return embedded
+
 '''
 # Inhetired from the one above - without padding
 def esm_MSA(peptide, pooling=False, add_padding=True):
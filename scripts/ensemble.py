@@ -0,0 +1,239 @@
+# Ensemble inference over K checkpoints of the same architecture (e.g. the cross-validation folds).
+#
+# The parameters of the K networks are stacked with torch.func.stack_module_state and the convolutional
+# front-end is run once per batch under vmap, so the batch is loaded once and all K feature maps come
+# out of one vectorized call. vmap has no batching rule for the LSTM, so the K BiLSTMs run as one
+# LSTM with stacked weights (stacked_lstm): every time step of every layer is a single batched matmul
+# over the K networks and both directions. predict returns the mean and variance of the K probabilities.
+#
+#   python ensemble.py --checkpoints fold_*.pt --model Net_project --embedding esm-1b
+
+import copy
+import glob
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
+from torch.utils.data import DataLoader
+
+import functions as func
+from model import Net, Net_project, Net_project3, Net_project4, load_checkpoint
+
+
+# The eval-mode forward of each network class split at its LSTM: the front-end maps the
+# (n, features, residues) input to the (n, length, filters) LSTM input, the head maps the
+# concatenated last hidden states to the output. Dropout is the identity in eval mode.
+def project_front(net, x):
+    x = net.conv1_bn(net.pool(F.relu(net.conv1(net.bn0(x)))))
+    x = net.conv2_bn(net.pool(F.relu(net.conv2(x))))
+    return x.transpose(2, 1)
+
+def project3_front(net, x):
+    x = net.conv1_bn(net.pool(F.relu(net.conv1(net.bn0(x)))))
+    x = net.conv2_bn(net.pool(F.relu(net.conv2(x))))
+    return net.pool(F.relu(net.conv3(x))).transpose(2, 1)
+
+def project4_front(net, x):
+    x = net.conv1_bn(net.pool(F.relu(net.conv1(net.bn0(x)))))
+    x = net.conv2_bn(net.pool(F.relu(net.conv2(x))))
+    # conv2 is applied twice, like Net_project4.forward
+    return net.pool(F.relu(net.conv2(x))).transpose(2, 1)
+
+def project_head(net, cat):
+    return net.fc1(cat)
+
+def project3_head(net, cat):
+    return net.fc2(net.ln_bn(net.relu(net.fc1(cat))))
+
+split_forward = {Net_project: (project_front, project_head),
+                 Net_project3: (project3_front, project3_head),
+                 Net_project4: (project4_front, project3_head)}
+
+def stack_lstm(rnns):
+    """
+    Weights of K bidirectional LSTMs of the same shape, per layer: input weights (2K, 4H, in),
+    transposed hidden weights (2K, H, 4H) and summed biases (2K, 1, 4H), network k at 2k (forward)
+    and 2k+1 (reverse).
+    """
+    layers = []
+    for layer in range(rnns[0].num_layers):
+        w_ih, w_hh, b = [], [], []
+        for rnn in rnns:
+            for suffix in ['', '_reverse']:
+                name = '_l{}{}'.format(layer, suffix)
+                w_ih.append(getattr(rnn, 'weight_ih' + name))
+                w_hh.append(getattr(rnn, 'weight_hh' + name).t())
+                b.append(getattr(rnn, 'bias_ih' + name) + getattr(rnn, 'bias_hh' + name))
+        layers.append((torch.stack(w_ih).detach(), torch.stack(w_hh).detach(), torch.stack(b).detach()[:, None, :]))
+    return layers
+
+def stacked_lstm(layers, x):
+    """
+    Eval-mode forward of K bidirectional LSTMs (stack_lstm) on their own inputs x (K, n, T, in).
+    Returns the last hidden states of both directions of the top layer (K, n, 2H), like
+    torch.cat((h[-2], h[-1]), dim=1) of every network. Gates are in torch's (i, f, g, o) order.
+    """
+    K, n, T, _ = x.shape
+    for w_ih, w_hh, b in layers:
+        H = w_hh.shape[1]
+        # the reverse direction reads the sequence backwards, (2K, T, n, in)
+        inputs = torch.stack((x, x.flip(2)), dim=1).reshape(2 * K, n, T, -1).transpose(1, 2)
+        # input projections of all time steps at once, (2K, T, n, 4H)
+        gates_x = torch.matmul(inputs, w_ih.transpose(1, 2)[:, None]) + b[:, None]
+        h = x.new_zeros(2 * K, n, H)
+        c = x.new_zeros(2 * K, n, H)
+        outputs = []
+        for t in range(T):
+            i, f, g, o = torch.baddbmm(gates_x[:, t], h, w_hh).chunk(4, dim=2)
+            c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+            h = torch.sigmoid(o) * torch.tanh(c)
+            outputs.append(h)
+        outputs = torch.stack(outputs, dim=2).reshape(K, 2, n, T, H)
+        x = torch.cat((outputs[:, 0], outputs[:, 1].flip(2)), dim=3)
+    h = h.reshape(K, 2, n, H)
+    return torch.cat((h[:, 0], h[:, 1]), dim=2)
+
+class FrontEnd(nn.Module):
+    """
+    The part of a network before its LSTM as a module, so it can be called with functional_call.
+    """
+    def __init__(self, net, front):
+        super(FrontEnd, self).__init__()
+        self.net = net
+        self.front = front
+
+    def forward(self, x):
+        return self.front(self.net, x)
+
+class StackedEnsemble:
+    """
+    K networks of the same class with stacked parameters. predict_proba takes complexes in the
+    (n, residues, features) layout of the data files like predict.TorchBackend, and returns the
+    mean and variance over the networks of the probabilities.
+    """
+    def __init__(self, nets, vectorize=True):
+        if len(set(type(net) for net in nets)) != 1:
+            raise ValueError("All networks of an ensemble must have the same architecture")
+        self.nets = [net.eval() for net in nets]
+        self.params, self.buffers = stack_module_state(self.nets)
+        base = copy.deepcopy(self.nets[0]).to('meta')
+        if type(base) in split_forward:
+            self.front, self.head = split_forward[type(base)]
+            # vmap runs FrontEnd(base), whose parameters are those of base under 'net.'
+            self.base = FrontEnd(base, self.front)
+            self.params = {'net.' + key: value for key, value in self.params.items()}
+            self.buffers = {'net.' + key: value for key, value in self.buffers.items()}
+            self.lstm = stack_lstm([net.rnn for net in self.nets])
+        elif isinstance(base, Net):
+            self.front, self.head = None, None
+            self.base = base
+        else:
+            raise ValueError("No ensemble forward for {}".format(type(base).__name__))
+        self.outputs_probabilities = isinstance(self.nets[0], Net)
+        self.vectorize = vectorize
+
+    def forward_one(self, params, buffers, x):
+        return functional_call(self.base, (params, buffers), (x,))
+
+    def forward_vectorized(self, x):
+        output = vmap(self.forward_one, in_dims=(0, 0, None))(self.params, self.buffers, x)
+        if self.head is None:
+            return output
+        cat = stacked_lstm(self.lstm, output)
+        return torch.stack([self.head(net, features) for net, features in zip(self.nets, cat)])
+
+    def forward(self, x):
+        """
+        Outputs of all networks for a (n, features, residues) batch, shape (K, n).
+        """
+        with torch.no_grad():
+            if self.vectorize:
+                output = self.forward_vectorized(x)
+            else:
+                output = torch.stack([net(x) for net in self.nets])
+            if not self.outputs_probabilities:
+                output = torch.sigmoid(output)
+        return output.reshape(len(self.nets), -1)
+
+    def predict_proba(self, x):
+        probs = self.forward(torch.from_numpy(np.ascontiguousarray(np.transpose(x, (0, 2, 1)), dtype=np.float32)))
+        return probs.mean(0).numpy(), probs.var(0, unbiased=False).numpy()
+
+    def predict(self, ldr):
+        """
+        Mean and variance of the probabilities and the targets over all batches of a loader,
+        plus the probabilities of every network (K, n).
+        """
+        probs, targs = [], []
+        for data, target in ldr:
+            probs.append(self.forward(data.float()).numpy())
+            targs.append(np.asarray(target, dtype=np.float32))
+        probs = np.concatenate(probs, axis=1)
+        return probs.mean(0), probs.var(0), np.concatenate(targs), probs
+
+def benchmark(ensemble, x, repeats=20, target=2.0):
+    """
+    Median seconds per batch of one network, of the vectorized ensemble and of a loop over the networks,
+    and whether the vectorized ensemble beats the loop and costs at most target times one network.
+    """
+    def median_time(fn):
+        fn(x)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn(x)
+            times.append(time.perf_counter() - start)
+        return float(np.median(times))
+
+    with torch.no_grad():
+        single = median_time(ensemble.nets[0])
+    vectorized = median_time(ensemble.forward)
+    ensemble.vectorize = False
+    looped = median_time(ensemble.forward)
+    ensemble.vectorize = True
+    return {'one network s': single, 'vectorized ensemble s': vectorized, 'looped ensemble s': looped,
+            'vectorized / one network': vectorized / single,
+            'faster than the loop': vectorized < looped,
+            'target met (<= {:g}x one network)'.format(target): vectorized <= target * single}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate an ensemble of checkpoints in one vectorized pass.")
+    parser.add_argument('--checkpoints', nargs='+', required=True, help="state dicts of networks of the same class")
+    parser.add_argument('--model', default="Net_project", help="network class in model.py")
+    parser.add_argument('--embedding', default="Baseline", help="Baseline, esm-1b or esm_ASM")
+    parser.add_argument('--no-energy', action='store_true', help="the networks were trained without energy terms")
+    parser.add_argument('--separated', action='store_true', help="the networks were trained on esm_1b_separated inputs")
+    parser.add_argument('--test', type=int, nargs='+', default=func.default_config['test_partitions'], help="partitions to score")
+    parser.add_argument('--bat-size', type=int, default=128)
+    parser.add_argument('--output', default=None, help="CSV with target, mean and variance of every complex")
+    args = parser.parse_args(argv)
+
+    paths = sorted(set(fp for pattern in args.checkpoints for fp in glob.glob(pattern)))
+    if not paths:
+        raise SystemExit("No checkpoints found")
+    ensemble = StackedEnsemble([load_checkpoint(path, args.model) for path in paths])
+
+    store_dir = func.partition_store(args.embedding, not args.no_energy, args.separated)
+    X, y, offsets = func.load_partition_store(store_dir)
+    ldr = DataLoader(func.PartitionDataset(X, y, offsets, args.test), batch_size=args.bat_size, shuffle=False)
+    mean, var, targs, probs = ensemble.predict(ldr)
+
+    for path, p in zip(paths, probs):
+        print("{}: test AUC {:.4f}".format(path, func.classification_metrics(targs, p)['AUC']))
+    metrics = func.classification_metrics(targs, mean)
+    print("ensemble of {}: test AUC {:.4f}  MCC {:.4f}  ACC {:.4f}".format(len(paths), metrics['AUC'], metrics['MCC'], metrics['ACC']))
+
+    x = torch.from_numpy(np.stack([ldr.dataset[i][0] for i in range(min(args.bat_size, len(ldr.dataset)))])).float()
+    for key, value in benchmark(ensemble, x).items():
+        print("{}: {}".format(key, value if isinstance(value, bool) else '{:.4f}'.format(value)))
+
+    if args.output:
+        pd.DataFrame({'target': targs, 'pred': mean, 'variance': var}).to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+# Inference-optimized export of a trained network.
+#
+# Every BatchNorm of the networks in model.py is folded into the layer that consumes its output
+# (next convolution, first LSTM layer or last linear layer), dropout is dropped, and the result is
+# scripted and frozen with TorchScript, or compiled with torch.compile. The exported graph is
+# checked against the eager network before it is saved.
+#
+#   python export.py --checkpoint checkpoint.pt --model Net_project --output model.ts
+#
+# A BatchNorm in front of a zero-padded convolution folds exactly only if the padding is done in
+# the folded input space, i.e. with the value -shift/scale of every channel instead of zero.
+# That is what PaddedConv1d does.
+
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model import Net, Net_project, Net_project3, Net_project4, load_checkpoint
+
+
+class PaddedConv1d(nn.Module):
+    """
+    Conv1d padding every input channel with its own constant instead of zero.
+    """
+    def __init__(self, weight, bias, stride, padding, pad_value):
+        super(PaddedConv1d, self).__init__()
+        self.weight = nn.Parameter(weight)
+        self.bias = nn.Parameter(bias)
+        self.stride = stride
+        self.padding = padding
+        self.register_buffer('pad_value', pad_value.reshape(1, -1, 1))
+
+    def forward(self, x):
+        if self.padding > 0:
+            pad = self.pad_value.expand(x.size(0), -1, self.padding)
+            x = torch.cat((pad, x, pad), dim=2)
+        return F.conv1d(x, self.weight, self.bias, self.stride)
+
+class ChannelAffine(nn.Module):
+    """
+    BatchNorm in eval mode as a per-channel scale and shift, used where it cannot be folded.
+    """
+    def __init__(self, scale, shift):
+        super(ChannelAffine, self).__init__()
+        self.register_buffer('scale', scale.reshape(1, -1, 1))
+        self.register_buffer('shift', shift.reshape(1, -1, 1))
+
+    def forward(self, x):
+        return x * self.scale + self.shift
+
+class FoldedCNN(nn.Module):
+    """
+    Net with its BatchNorms folded: convolutions, flatten, fc1 and sigmoid.
+    """
+    def __init__(self, convs, pool, fc1):
+        super(FoldedCNN, self).__init__()
+        self.convs = convs
+        self.pool = pool
+        self.fc1 = fc1
+
+    def forward(self, x):
+        for conv in self.convs:
+            x = self.pool(F.relu(conv(x)))
+        x = x.reshape(x.size(0), -1)
+        return torch.sigmoid(self.fc1(x))
+
+class FoldedCNNRNN(nn.Module):
+    """
+    Net_project, Net_project3 and Net_project4 with their BatchNorms folded:
+    convolutions, BiLSTM and the linear head (logits).
+    """
+    def __init__(self, convs, pool, rnn, head):
+        super(FoldedCNNRNN, self).__init__()
+        self.convs = convs
+        self.pool = pool
+        self.rnn = rnn
+        self.head = head
+
+    def forward(self, x):
+        for conv in self.convs:
+            x = self.pool(F.relu(conv(x)))
+        x = x.transpose(2, 1)
+        x, (h, c) = self.rnn(x)
+        cat = torch.cat((h[-2, :, :], h[-1, :, :]), dim=1)
+        return self.head(cat)
+
+def bn_affine(bn):
+    """
+    Scale and shift of a BatchNorm in eval mode.
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    return scale, bn.bias - bn.running_mean * scale
+
+def fold_bn_into_conv(bn, conv):
+    """
+    Fold a BatchNorm into the convolution that follows it. Falls back to an explicit affine
+    in front of the convolution when a channel has scale 0 (its pad value would be infinite).
+    """
+    conv = copy.deepcopy(conv)
+    if bn is None:
+        return conv
+    scale, shift = bn_affine(bn)
+    if (scale == 0).any() or conv.padding_mode != 'zeros':
+        return nn.Sequential(ChannelAffine(scale, shift), conv)
+    weight = conv.weight * scale.reshape(1, -1, 1)
+    bias = (conv.bias if conv.bias is not None else 0) + (conv.weight * shift.reshape(1, -1, 1)).sum(dim=(1, 2))
+    return PaddedConv1d(weight, bias, conv.stride[0], conv.padding[0], -shift / scale)
+
+def fold_bn_into_linear(bn, linear):
+    """
+    Fold a BatchNorm into the linear layer that follows it. The linear layer may take the
+    flattened (channels x positions) output of a BatchNorm1d over channels, like fc1 of Net.
+    """
+    scale, shift = bn_affine(bn)
+    repeats = linear.in_features // scale.numel()
+    scale, shift = scale.repeat_interleave(repeats), shift.repeat_interleave(repeats)
+    linear = copy.deepcopy(linear)
+    linear.bias.copy_(linear.bias + linear.weight @ shift)
+    linear.weight.copy_(linear.weight * scale)
+    return linear
+
+def fold_bn_into_lstm(bn, rnn):
+    """
+    Fold a BatchNorm over the input features into the input weights of the first LSTM layer.
+    """
+    scale, shift = bn_affine(bn)
+    rnn = copy.deepcopy(rnn)
+    for suffix in ['_l0', '_l0_reverse'] if rnn.bidirectional else ['_l0']:
+        weight = getattr(rnn, 'weight_ih' + suffix)
+        getattr(rnn, 'bias_ih' + suffix).add_(weight @ shift)
+        weight.mul_(scale)
+    rnn.flatten_parameters()
+    return rnn
+
+def conv_stack(net):
+    """
+    The convolutions of a network with the BatchNorm applied to the input of each,
+    and the BatchNorm on the output of the last one (or None).
+    """
+    if isinstance(net, Net_project3):
+        return [(net.bn0, net.conv1), (net.conv1_bn, net.conv2), (net.conv2_bn, net.conv3)], None
+    if isinstance(net, Net_project4):
+        # conv2 is applied twice, the two uses get their own folded copy
+        return [(net.bn0, net.conv1), (net.conv1_bn, net.conv2), (net.conv2_bn, net.conv2)], None
+    if isinstance(net, (Net, Net_project)):
+        return [(net.bn0, net.conv1), (net.conv1_bn, net.conv2)], net.conv2_bn
+    raise ValueError("Folding is not supported for {}".format(type(net).__name__))
+
+def fold_model(net):
+    """
+    Equivalent of a network in eval mode without BatchNorm and dropout layers.
+    """
+    net = net.eval()
+    with torch.no_grad():
+        stack, last_bn = conv_stack(net)
+        convs = nn.ModuleList([fold_bn_into_conv(bn, conv) for bn, conv in stack])
+        if isinstance(net, Net):
+            return FoldedCNN(convs, copy.deepcopy(net.pool), fold_bn_into_linear(last_bn, net.fc1)).eval()
+
+        rnn = fold_bn_into_lstm(last_bn, net.rnn) if last_bn is not None else copy.deepcopy(net.rnn)
+        if hasattr(net, 'fc2'):
+            head = nn.Sequential(copy.deepcopy(net.fc1), nn.ReLU(), fold_bn_into_linear(net.ln_bn, net.fc2))
+        else:
+            head = nn.Sequential(copy.deepcopy(net.fc1))
+        return FoldedCNNRNN(convs, copy.deepcopy(net.pool), rnn, head).eval()
+
+def export(net, example, backend='torchscript'):
+    """
+    Fold a network and turn it into a frozen TorchScript module or a torch.compile'd function.
+    example is an input batch (n, features, residues), run once so compilation happens here.
+    """
+    folded = fold_model(net)
+    if backend == 'torchscript':
+        exported = torch.jit.freeze(torch.jit.script(folded))
+        exported = torch.jit.optimize_for_inference(exported)
+    elif backend == 'compile':
+        exported = torch.compile(folded)
+    elif backend == 'eager':
+        exported = folded
+    else:
+        raise ValueError("Unknown backend {}, choose from torchscript, compile, eager".format(backend))
+    with torch.no_grad():
+        exported(example)   # compiles / specializes on the first call
+    return exported
+
+def check_parity(net, exported, x, atol=1e-4):
+    """
+    Largest absolute difference between the outputs of the eager network and the exported one.
+    Raises if it is above atol.
+    """
+    with torch.no_grad():
+        diff = (net.eval()(x) - exported(x)).abs().max().item()
+    if diff > atol:
+        raise RuntimeError("Exported network differs from the eager one by {:.2e} (atol {:.0e})".format(diff, atol))
+    return diff
+
+def benchmark_latency(fn, x, repeats=50, warmup=5):
+    """
+    Median and 90th percentile latency (ms) of fn(x).
+    """
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            start = time.perf_counter()
+            fn(x)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return {'median ms': float(np.median(times)), 'p90 ms': float(np.percentile(times, 90))}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fold BatchNorms and export a trained network with TorchScript.")
+    parser.add_argument('--checkpoint', required=True, help="state dict saved during training")
+    parser.add_argument('--model', default="Net_project", help="network class in model.py")
+    parser.add_argument('--output', default="model.ts", help="TorchScript file to write")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32, 128])
+    parser.add_argument('--compile', action='store_true', help="also benchmark torch.compile")
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    net = load_checkpoint(args.checkpoint, args.model)
+    n_features = net.bn0.num_features
+    example = torch.randn(max(args.batch_sizes), n_features, 420)
+
+    backends = ['eager', 'torchscript'] + (['compile'] if args.compile else [])
+    exported = {backend: export(net, example, backend) for backend in backends}
+    for backend, fn in exported.items():
+        print("{:12s} max abs difference to eager: {:.2e}".format(backend, check_parity(net, fn, example)))
+
+    exported['torchscript'].save(args.output)
+    print("Saved", args.output)
+
+    for batch_size in args.batch_sizes:
+        x = example[:batch_size]
+        row = {'unfolded': benchmark_latency(net, x)}
+        row.update({'folded ' + backend: benchmark_latency(fn, x) for backend, fn in exported.items()})
+        print("batch size {}: ".format(batch_size) +
+              ", ".join("{} {:.2f} ms".format(name, r['median ms']) for name, r in row.items()))
+
+
+if __name__ == '__main__':
+    main()
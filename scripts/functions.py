@@ -1,11 +1,15 @@
+import os
+import glob
+import pickle
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import torch
 import math
-from sklearn.metrics import accuracy_score, accuracy_score, roc_auc_score, roc_curve, auc
+from sklearn.metrics import accuracy_score, accuracy_score, roc_auc_score, roc_curve, auc, matthews_corrcoef
 import random
 from sklearn.decomposition import PCA
+from model import build_model
 
 seed_val = 42
 random.seed(seed_val)
@@ -14,6 +18,21 @@ torch.manual_seed(seed_val)
 torch.cuda.manual_seed_all(seed_val)
 torch.use_deterministic_algorithms(True)
 
+# Fixed training parameters of main3.ipynb, used by the scripted training runs
+default_config = {'modelName': 'Net_project',
+                  'numHN': 32,
+                  'numFilter': 100,
+                  'dropOutRate': 0.1,
+                  'learning_rate': 0.001,
+                  'weight_decay': 0.0001,
+                  'bat_size': 128,
+                  'epochs': 100,
+                  'patience': 10,
+                  'train_partitions': [0, 1, 2],
+                  'valid_partitions': [3],
+                  'test_partitions': [4],
+                  'checkpoint': 'checkpoint.pt'}
+
 
 def return_aa(one_hot):
     mapping = dict(zip(range(20),"ACDEFGHIKLMNPQRSTVWY"))
@@ -98,28 +117,102 @@ def prepare_data_pca(embedded_list):
     ready to run the PCA analysis afterwards.
     """
     n_observations = len(embedded_list)
-    n_residues = len(embedded_list[0])
-    embedded_att = len(embedded_list[0][0])
-    embedded_matrix = torch.tensor(embedded_list).reshape(n_observations * n_residues, embedded_att).numpy()
-    return n_observations, embedded_matrix
+    embedded_matrix = np.asarray(embedded_list, dtype=np.float32)
+    return n_observations, embedded_matrix.reshape(-1, embedded_matrix.shape[-1])
+
+class ProjectionPCA:
+    """
+    PCA projection fitted on residue rows only. All-zero padding rows are left out of the fit
+    and stay zero after transform, so the padding of the 420-row layout is preserved.
+    """
+    zero_padding = True
+
+    def __init__(self, components, mean, explained_variance_ratio):
+        self.components_ = components
+        self.mean_ = mean
+        self.explained_variance_ratio_ = explained_variance_ratio
+        self.n_components_ = len(components)
+
+    def transform(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        projected = (X - self.mean_) @ self.components_.T
+        projected[~X.any(axis=-1)] = 0
+        return projected
+
+    def truncate(self, n_components):
+        """
+        Projection on the first n_components components only.
+        """
+        return ProjectionPCA(self.components_[:n_components], self.mean_, self.explained_variance_ratio_[:n_components])
+
+def residue_rows(matrix):
+    """
+    Rows of a (rows x features) matrix that are not all-zero padding.
+    """
+    return matrix[matrix.any(axis=1)]
+
+def fit_pca(data, max_components=100):
+    """
+    Fit max_components components with a randomized SVD on the residue rows of a (rows x features) matrix.
+    """
+    rows = residue_rows(np.asarray(data, dtype=np.float32))
+    model = PCA(n_components=min(max_components, rows.shape[1]), svd_solver='randomized', random_state=seed_val)
+    model.fit(rows)
+    return ProjectionPCA(model.components_.astype(np.float32), model.mean_.astype(np.float32), model.explained_variance_ratio_)
+
+def fit_pca_store(X, offsets, partitions, max_components=100, chunk_size=256):
+    """
+    Fit max_components components incrementally on the residue rows of some partitions of a
+    (memory-mapped) partition store, chunk_size complexes at a time.
+    """
+    from sklearn.decomposition import IncrementalPCA
+    n_components = min(max_components, X.shape[2])
+    model = IncrementalPCA(n_components=n_components)
+    pending = []
+    n_pending = 0
+    # the last full batch is fitted one batch late, so a short final batch can be merged into it
+    held = None
+    for p in partitions:
+        for start in range(offsets[p], offsets[p+1], chunk_size):
+            rows = residue_rows(np.asarray(X[start:min(start + chunk_size, offsets[p+1])], dtype=np.float32).reshape(-1, X.shape[2]))
+            pending.append(rows)
+            n_pending += len(rows)
+            # partial_fit needs at least n_components rows per call
+            if n_pending >= max(n_components, 4096):
+                if held is not None:
+                    model.partial_fit(held)
+                held = np.concatenate(pending)
+                pending, n_pending = [], 0
+    if held is not None and n_pending < n_components:
+        held = np.concatenate([held] + pending)
+        pending = []
+    if held is not None:
+        model.partial_fit(held)
+    if pending:
+        model.partial_fit(np.concatenate(pending))
+    return ProjectionPCA(model.components_.astype(np.float32), model.mean_.astype(np.float32), model.explained_variance_ratio_)
+
+def components_for_variance(variances, variance_required):
+    """
+    Smallest number of components whose cumulative explained variance exceeds variance_required
+    (all of them if it is never reached).
+    """
+    reached = np.flatnonzero(variances > variance_required)
+    return int(reached[0]) + 1 if len(reached) else len(variances)
 
 def run_PCA(data, variance_required = 0.9, max_components = 100):
     """
     Run PCA and get the minimum number of components required to reach 
-    the minimum variance required.
+    the minimum variance required. The PCA is fitted once on the residue
+    rows and truncated to the optimal number of components.
     """
-    # add condition for baseline model where its just has 54 components
-    #if data.shape[1] < max_components:
-    #    max_components = int(data.shape[1])
-    
-    first_model = PCA(n_components = max_components)
-    first_model.fit_transform(data)
+    first_model = fit_pca(data, max_components)
 
     variances = first_model.explained_variance_ratio_.cumsum()
-    optimal_components = np.argmax(variances > variance_required)
+    optimal_components = components_for_variance(variances, variance_required)
 
-    reduced_model = PCA(n_components = optimal_components)
-    fitted_data = reduced_model.fit_transform(data)
+    reduced_model = first_model.truncate(optimal_components)
+    fitted_data = reduced_model.transform(data)
 
     return variances, optimal_components, reduced_model, fitted_data
 
@@ -128,8 +221,121 @@ def back_to_original_size(matrix, final_size):
     Reshape matrix back to original 3D shape with the reduced dimensionality
     for the embedded variable. 
     """
-    final_tensor = torch.tensor(matrix).reshape(final_size[0], final_size[1], final_size[2]).numpy()
-    return final_tensor
+    return np.asarray(matrix).reshape(final_size[0], final_size[1], final_size[2])
+
+def load_partitions(train_dir='../data/train', validation_dir='../data/validation'):
+    """
+    Read the five npz partitions and their labels in partition order,
+    the same way main3.ipynb does.
+    """
+    data_list = []
+    target_list = []
+    for index in range(5):
+        for fp in glob.glob(os.path.join(train_dir, "*{}*input.npz".format(index+1))):
+            data_list.append(np.load(fp)["arr_0"])
+            target_list.append(np.load(fp.replace("input", "labels"))["arr_0"])
+    for fp in glob.glob(os.path.join(validation_dir, "*5*input.npz")):
+        data_list.append(np.load(fp)["arr_0"])
+        target_list.append(np.load(fp.replace("input", "labels"))["arr_0"])
+    return data_list, target_list
+
+def add_energy_terms(data_list_enc, data_list):
+    """
+    Append the padded energy terms of the original dataset to every embedded complex.
+    """
+    for i in range(len(data_list_enc)):
+        energy_set = extract_energy_terms(data_list[i])
+        for j in range(0, len(energy_set)):
+            pad = 420 - len(energy_set[j])
+            energy_set[j] = np.pad(energy_set[j], ((0, pad), (0, 0)), 'constant')
+            data_list_enc[i][j] = np.concatenate((data_list_enc[i][j], energy_set[j]), axis=1)
+    return data_list_enc
+
+def load_embedded_partitions(embedding, keep_energy, esm_1b_separated=False, embedding_dir='../data/embeddedFiles/',
+                             separated_file='esm-energies-file-MSA-{}.pkl'):
+    """
+    Load the partitions with the given embedding and their labels, appending the energy
+    terms if keep_energy. Whole-complex embeddings are the pickles written by encoder.py,
+    separately embedded chains the per-partition files of encode_separately_MSA.ipynb
+    (which already contain the energy terms).
+    """
+    data_list, target_list = load_partitions()
+    if embedding == "Baseline":
+        return data_list, target_list
+    if esm_1b_separated:
+        data_list_enc = []
+        for file_index in range(len(data_list)):
+            with open(separated_file.format(file_index+1), 'rb') as infile:
+                data_list_enc.append(pickle.load(infile))
+        return data_list_enc, target_list
+    with open(os.path.join(embedding_dir, 'dataset-{}'.format(embedding)), 'rb') as infile:
+        data_list_enc = pickle.load(infile)
+    if keep_energy:
+        data_list_enc = add_energy_terms(data_list_enc, data_list)
+    return data_list_enc, target_list
+
+def partition_store(embedding, keep_energy, esm_1b_separated=False, store_root='../data/partitionStore/'):
+    """
+    Directory of the partition store of an embedding, written on first use.
+    """
+    if esm_1b_separated:
+        keep_energy = False
+    store_dir = os.path.join(store_root, '{}_energy_{}_separated_{}'.format(embedding, keep_energy, esm_1b_separated))
+    if not os.path.exists(os.path.join(store_dir, 'X.npy')):
+        print('Writing partition store to', store_dir)
+        data_list_enc, target_list = load_embedded_partitions(embedding, keep_energy, esm_1b_separated)
+        save_partition_store(data_list_enc, target_list, store_dir)
+    return store_dir
+
+def save_partition_store(data_list_enc, target_list, store_dir):
+    """
+    Write the (embedded) partitions into a single float32 .npy file, plus labels
+    and partition offsets, so several processes can memory-map one read-only copy.
+    Complexes are copied one at a time, so the partitions are never concatenated in memory.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    offsets = np.concatenate(([0], np.cumsum([len(partition) for partition in data_list_enc])))
+    n_rows, n_features = np.shape(data_list_enc[0][0])
+    X = np.lib.format.open_memmap(os.path.join(store_dir, 'X.npy'), mode='w+', dtype=np.float32,
+                                  shape=(int(offsets[-1]), n_rows, n_features))
+    for p, partition in enumerate(data_list_enc):
+        for i, cmplx in enumerate(partition):
+            X[offsets[p] + i] = cmplx
+    X.flush()
+    del X
+    np.save(os.path.join(store_dir, 'y.npy'), np.concatenate(target_list).astype(np.float32))
+    np.save(os.path.join(store_dir, 'offsets.npy'), offsets)
+
+def load_partition_store(store_dir, mmap_mode='r'):
+    """
+    Open a store written by save_partition_store. X is memory-mapped by default.
+    """
+    X = np.load(os.path.join(store_dir, 'X.npy'), mmap_mode=mmap_mode)
+    y = np.load(os.path.join(store_dir, 'y.npy'))
+    offsets = np.load(os.path.join(store_dir, 'offsets.npy'))
+    return X, y, offsets
+
+class PartitionDataset(torch.utils.data.Dataset):
+    """
+    Complexes of some partitions of a partition store, returned as
+    [features x residues, target] pairs like the notebooks' train_ds lists.
+    transform (e.g. a fitted PCA projection) is applied to every complex as it is read.
+    """
+    def __init__(self, X, y, offsets, partitions, transform=None):
+        self.X = X
+        self.y = y
+        self.indices = np.concatenate([np.arange(offsets[p], offsets[p+1]) for p in partitions])
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        index = self.indices[i]
+        cmplx = self.X[index]
+        if self.transform is not None:
+            cmplx = self.transform.transform(cmplx)
+        return np.ascontiguousarray(cmplx.T), self.y[index]
 
 def construct_pssm(data):
     beta = 50.0
@@ -264,6 +470,65 @@ def construct_pssm(data):
 
 
 
+def predict_proba(net, ldr):
+    """
+    Sigmoid outputs and targets of a network over all batches of a loader.
+    """
+    net.eval()
+    probs, targs = [], []
+    with torch.no_grad():
+        for data, target in ldr:
+            probs.append(torch.sigmoid(net(data.float())).numpy().ravel())
+            targs.append(np.asarray(target, dtype=np.float32))
+    return np.concatenate(probs), np.concatenate(targs)
+
+def classification_metrics(targs, probs):
+    """
+    AUC from the probabilities, MCC and ACC from the rounded predictions.
+    """
+    preds = np.round(probs)
+    return {'AUC': roc_auc_score(targs, probs),
+            'MCC': matthews_corrcoef(targs, preds),
+            'ACC': accuracy_score(targs, preds)}
+
+def train_on_store(X, y, offsets, config, epoch_callback=None):
+    """
+    Train config['modelName'] with train_project on the train/valid partitions of a
+    partition store and evaluate it on the test partitions.
+    """
+    torch.manual_seed(seed_val)
+    train_ds = PartitionDataset(X, y, offsets, config['train_partitions'])
+    val_ds = PartitionDataset(X, y, offsets, config['valid_partitions'])
+    test_ds = PartitionDataset(X, y, offsets, config['test_partitions'])
+    train_ldr = torch.utils.data.DataLoader(train_ds, batch_size=config['bat_size'], shuffle=True)
+    val_ldr = torch.utils.data.DataLoader(val_ds, batch_size=config['bat_size'], shuffle=True)
+    test_ldr = torch.utils.data.DataLoader(test_ds, batch_size=config['bat_size'])
+
+    net = build_model(config['modelName'], X.shape[2], config['numHN'], config['numFilter'], config['dropOutRate'])
+    optimizer = torch.optim.Adam(net.parameters(), lr=config['learning_rate'],
+                                 weight_decay=config['weight_decay'],
+                                 amsgrad=True,)
+    criterion = torch.nn.BCEWithLogitsLoss()
+
+    train_acc, train_losses, train_auc, valid_acc, valid_losses, valid_auc = train_project(
+        net, optimizer, train_ldr, val_ldr, [], val_ds, config['epochs'], criterion, config['patience'],
+        epoch_callback=epoch_callback)[:6]
+
+    if config.get('checkpoint'):
+        torch.save(net.state_dict(), config['checkpoint'])
+
+    test_probs, test_targs = predict_proba(net, test_ldr)
+    metrics = classification_metrics(test_targs, test_probs)
+
+    return {'epochs': len(train_losses),
+            'train ACC': train_acc[-1],
+            'train AUC': train_auc[-1],
+            'valid ACC': valid_acc[-1],
+            'valid AUC': valid_auc[-1],
+            'test AUC': metrics['AUC'],
+            'test MCC': metrics['MCC'],
+            'test ACC': metrics['ACC']}
+
 def plot_losses(valid_loss,train_loss,burn_in=20):
     plt.figure(figsize=(15,4))
     plt.plot(list(range(burn_in, len(train_loss))), train_loss[burn_in:], label='Training loss')
@@ -343,7 +608,11 @@ class EarlyStopping:
         self.val_loss_min = val_loss
 
 
-def train_project(net, optimizer, train_ldr, val_ldr, test_ldr, X_valid, epochs, criterion, early_stop):
+def train_project(net, optimizer, train_ldr, val_ldr, test_ldr, X_valid, epochs, criterion, early_stop, epoch_callback=None):
+    """
+    epoch_callback(epoch, valid_auc), if given, is called after every validation
+    and stops the training when it returns True (used by the asha scheduler).
+    """
     num_epochs = epochs
 
     train_acc = []
@@ -361,7 +630,7 @@ def train_project(net, optimizer, train_ldr, val_ldr, test_ldr, X_valid, epochs,
     no_epoch_improve = 0
     min_val_loss = np.Inf
 
-    test_probs, test_preds, test_targs, test_peptides = [], [], [], []
+    test_probs, test_preds, test_targs, test_peptides, test_predsROC = [], [], [], [], []
 
     for epoch in range(num_epochs):
         cur_loss = 0
@@ -418,6 +687,10 @@ def train_project(net, optimizer, train_ldr, val_ldr, test_ldr, X_valid, epochs,
             train_auc.append(train_auc_cur)
             valid_auc.append(valid_auc_cur)
 
+        if epoch_callback is not None and epoch_callback(epoch, valid_auc_cur):
+            print("Stopped by scheduler at epoch {}\n".format(epoch))
+            break
+
         # Early stopping
         if (val_loss / len(X_valid)).item() < min_val_loss:
             no_epoch_improve = 0
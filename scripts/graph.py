@@ -54,17 +54,7 @@ def extract_sequences(dataset_X, merge=False):
                                  "TCR":tcr_sequences})
         
     return df_sequences    
-# nomarlize
-def dic_normalize(dic):
-    # print(dic)
-    max_value = dic[max(dic, key=dic.get)]
-    min_value = dic[min(dic, key=dic.get)]
-    # print(max_value)
-    interval = float(max_value) - float(min_value)
-    for key in dic.keys():
-        dic[key] = (dic[key] - min_value) / interval
-    dic['X'] = (max_value + min_value) / 2.0
-    return dic
+
 
 
 
@@ -114,142 +104,33 @@ seq_keys.append(produced_key(1168))
 seq_keys.append(produced_key(1526))
 seq_keys.append(produced_key(1207))
 #print(seq_keys[0][0])
-seq_lists=[]
-for n in range(5):
-    m = n+1
-    seq_dir = os.path.join('GNN_data','data_all',str(m),'seq')
-    seq_list=[]
-    for i in range(len(seq_keys[n])):
-        seq_file = os.path.join(seq_dir, str(seq_keys[n][i])+ '.fasta')
-        infile = open(seq_file)
-        for line in infile:
-            if line.startswith('>'):
-                pass
-            else: 
-                seq_list.append(line.strip())
-    seq_lists.append(seq_list)
+# the precomputed partitions of graph_store.py replace the graph building below
+use_graph_store = True
+# None for PSSM node features and pconsc4 contacts, or an ESM embedding (esm-1b, esm_ASM) whose
+# representations and contact predictions make the graphs, needs use_graph_store
+graph_embedding = None
+
+if not use_graph_store:
+    seq_lists=[]
+    for n in range(5):
+        m = n+1
+        seq_dir = os.path.join('GNN_data','data_all',str(m),'seq')
+        seq_list=[]
+        for i in range(len(seq_keys[n])):
+            seq_file = os.path.join(seq_dir, str(seq_keys[n][i])+ '.fasta')
+            infile = open(seq_file)
+            for line in infile:
+                if line.startswith('>'):
+                    pass
+                else: 
+                    seq_list.append(line.strip())
+        seq_lists.append(seq_list)
         
 
-print("Sequences are extracted")
-
-pro_res_table = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y',
-                 'X']
-
-pro_res_aliphatic_table = ['A', 'I', 'L', 'M', 'V']
-pro_res_aromatic_table = ['F', 'W', 'Y']
-pro_res_polar_neutral_table = ['C', 'N', 'Q', 'S', 'T']
-pro_res_acidic_charged_table = ['D', 'E']
-pro_res_basic_charged_table = ['H', 'K', 'R']
-
-res_weight_table = {'A': 71.08, 'C': 103.15, 'D': 115.09, 'E': 129.12, 'F': 147.18, 'G': 57.05, 'H': 137.14,
-                    'I': 113.16, 'K': 128.18, 'L': 113.16, 'M': 131.20, 'N': 114.11, 'P': 97.12, 'Q': 128.13,
-                    'R': 156.19, 'S': 87.08, 'T': 101.11, 'V': 99.13, 'W': 186.22, 'Y': 163.18}
-
-res_pka_table = {'A': 2.34, 'C': 1.96, 'D': 1.88, 'E': 2.19, 'F': 1.83, 'G': 2.34, 'H': 1.82, 'I': 2.36,
-                 'K': 2.18, 'L': 2.36, 'M': 2.28, 'N': 2.02, 'P': 1.99, 'Q': 2.17, 'R': 2.17, 'S': 2.21,
-                 'T': 2.09, 'V': 2.32, 'W': 2.83, 'Y': 2.32}
-
-res_pkb_table = {'A': 9.69, 'C': 10.28, 'D': 9.60, 'E': 9.67, 'F': 9.13, 'G': 9.60, 'H': 9.17,
-                 'I': 9.60, 'K': 8.95, 'L': 9.60, 'M': 9.21, 'N': 8.80, 'P': 10.60, 'Q': 9.13,
-                 'R': 9.04, 'S': 9.15, 'T': 9.10, 'V': 9.62, 'W': 9.39, 'Y': 9.62}
-
-res_pkx_table = {'A': 0.00, 'C': 8.18, 'D': 3.65, 'E': 4.25, 'F': 0.00, 'G': 0, 'H': 6.00,
-                 'I': 0.00, 'K': 10.53, 'L': 0.00, 'M': 0.00, 'N': 0.00, 'P': 0.00, 'Q': 0.00,
-                 'R': 12.48, 'S': 0.00, 'T': 0.00, 'V': 0.00, 'W': 0.00, 'Y': 0.00}
-
-res_pl_table = {'A': 6.00, 'C': 5.07, 'D': 2.77, 'E': 3.22, 'F': 5.48, 'G': 5.97, 'H': 7.59,
-                'I': 6.02, 'K': 9.74, 'L': 5.98, 'M': 5.74, 'N': 5.41, 'P': 6.30, 'Q': 5.65,
-                'R': 10.76, 'S': 5.68, 'T': 5.60, 'V': 5.96, 'W': 5.89, 'Y': 5.96}
-
-res_hydrophobic_ph2_table = {'A': 47, 'C': 52, 'D': -18, 'E': 8, 'F': 92, 'G': 0, 'H': -42, 'I': 100,
-                             'K': -37, 'L': 100, 'M': 74, 'N': -41, 'P': -46, 'Q': -18, 'R': -26, 'S': -7,
-                             'T': 13, 'V': 79, 'W': 84, 'Y': 49}
-res_hydrophobic_ph7_table = {'A': 41, 'C': 49, 'D': -55, 'E': -31, 'F': 100, 'G': 0, 'H': 8, 'I': 99,
-                             'K': -23, 'L': 97, 'M': 74, 'N': -28, 'P': -46, 'Q': -10, 'R': -14, 'S': -5,
-                             'T': 13, 'V': 76, 'W': 97, 'Y': 63}
-
-res_weight_table = dic_normalize(res_weight_table)
-res_pka_table = dic_normalize(res_pka_table)
-res_pkb_table = dic_normalize(res_pkb_table)
-res_pkx_table = dic_normalize(res_pkx_table)
-res_pl_table = dic_normalize(res_pl_table)
-res_hydrophobic_ph2_table = dic_normalize(res_hydrophobic_ph2_table)
-res_hydrophobic_ph7_table = dic_normalize(res_hydrophobic_ph7_table)
-
-
-# one ont encoding
-def one_of_k_encoding(x, allowable_set):
-    if x not in allowable_set:
-        # print(x)
-        raise Exception('input {0} not in allowable set{1}:'.format(x, allowable_set))
-    return list(map(lambda s: x == s, allowable_set))
-
-
-def one_of_k_encoding_unk(x, allowable_set):
-    '''Maps inputs not in the allowable set to the last element.'''
-    if x not in allowable_set:
-        #print(x)
-        x = allowable_set[-1]
-    return list(map(lambda s: x == s, allowable_set))
-
-def residue_features(residue):
-    res_property1 = [1 if residue in pro_res_aliphatic_table else 0, 1 if residue in pro_res_aromatic_table else 0,
-                     1 if residue in pro_res_polar_neutral_table else 0,
-                     1 if residue in pro_res_acidic_charged_table else 0,
-                     1 if residue in pro_res_basic_charged_table else 0]
-    res_property2 = [res_weight_table[residue], res_pka_table[residue], res_pkb_table[residue], res_pkx_table[residue],
-                     res_pl_table[residue], res_hydrophobic_ph2_table[residue], res_hydrophobic_ph7_table[residue]]
-    # print(np.array(res_property1 + res_property2).shape)
-    return np.array(res_property1 + res_property2)
-
-
-# target feature for target graph
-def PSSM_calculation(aln_file, pro_seq):
-    pfm_mat = np.zeros((len(pro_res_table), len(pro_seq)))
-    with open(aln_file, 'r') as f:
-        line_count = len(f.readlines())
-        for line in f.readlines():
-            if len(line) != len(pro_seq):
-                print('error', len(line), len(pro_seq))
-                continue
-            count = 0
-            for res in line:
-                if res not in pro_res_table:
-                    count += 1
-                    continue
-                pfm_mat[pro_res_table.index(res), count] += 1
-                count += 1
-    # ppm_mat = pfm_mat / float(line_count)
-    pseudocount = 0.8
-    ppm_mat = (pfm_mat + pseudocount / 4) / (float(line_count) + pseudocount)
-    pssm_mat = ppm_mat
-    # k = float(len(pro_res_table))
-    # pwm_mat = np.log2(ppm_mat / (1.0 / k))
-    # pssm_mat = pwm_mat
-    # print(pssm_mat)
-    return pssm_mat
-
-def seq_feature(pro_seq):
-    pro_hot = np.zeros((len(pro_seq), len(pro_res_table)))
-    pro_property = np.zeros((len(pro_seq), 12))
-    for i in range(len(pro_seq)):
-        # if 'X' in pro_seq:
-        #     print(pro_seq)
-        pro_hot[i,] = one_of_k_encoding(pro_seq[i], pro_res_table)
-        pro_property[i,] = residue_features(pro_seq[i])
-    return np.concatenate((pro_hot, pro_property), axis=1)
-
-
-def target_feature(aln_file, pro_seq):
-    pssm = PSSM_calculation(aln_file, pro_seq)
-    other_feature = seq_feature(pro_seq)
-    # print('target_feature')
-    # print(pssm.shape)
-    # print(other_feature.shape)
-
-    # print(other_feature.shape)
-    # return other_feature
-    return np.concatenate((np.transpose(pssm, (1, 0)), other_feature), axis=1)
+    print("Sequences are extracted")
+
+from graph_features import (pro_res_table, one_of_k_encoding, one_of_k_encoding_unk, residue_features,
+                            PSSM_calculation, seq_feature, target_feature, normalized_edge_weight)
 
 # target aln file save in data/dataset/aln
 def target_to_feature(target_key, target_sequence, aln_dir):
@@ -276,41 +157,48 @@ def target_to_graph(target_key, target_sequence, contact_dir, aln_dir):
     return target_size, target_feature, target_edge_index
 #print(len(seq_keys))
 
-seq_graphs=[]
-for n in range(5):
-    m = n+1
-    aln_dir = os.path.join('GNN_data','data_all',str(m),'aln')
-    pconsc4_dir = os.path.join('GNN_data','data_all',str(m), 'pconsc4')
-    seq_graph = []
-    for i in range(len(seq_keys[n])):
+if not use_graph_store:
+    seq_graphs=[]
+    for n in range(5):
+        m = n+1
+        aln_dir = os.path.join('GNN_data','data_all',str(m),'aln')
+        pconsc4_dir = os.path.join('GNN_data','data_all',str(m), 'pconsc4')
+        seq_graph = []
+        for i in range(len(seq_keys[n])):
         
-        g = target_to_graph(str(seq_keys[n][i]),seq_lists[n][i],pconsc4_dir,aln_dir)
-        seq_graph.append(g)
-    seq_graphs.append(seq_graph)
-
-energy_set = energy_term(data_list)
-
-
-en_train = np.concatenate(energy_set[1:4])
-#print(len(en_train))
-X_train = np.concatenate(seq_graphs[0:3])
-#print(len(X_train))
-y_train = np.concatenate(target_list[1:4])
-#print(X_train[0],y_train[0])
-#print(len(y_train))
-en_valid = energy_set[0]
-X_valid = seq_graphs[3]
-y_valid = target_list[0]
-#print(len(en_valid))
-#print(len(X_valid))
-en_test = energy_set[4]
-X_test = seq_graphs[4]
-y_test = target_list[4]
+            g = target_to_graph(str(seq_keys[n][i]),seq_lists[n][i],pconsc4_dir,aln_dir)
+            seq_graph.append(g)
+        seq_graphs.append(seq_graph)
+
+    energy_set = energy_term(data_list)
+
+
+    en_train = np.concatenate(energy_set[1:4])
+    #print(len(en_train))
+    X_train = np.concatenate(seq_graphs[0:3])
+    #print(len(X_train))
+    y_train = np.concatenate(target_list[1:4])
+    #print(X_train[0],y_train[0])
+    #print(len(y_train))
+    en_valid = energy_set[0]
+    X_valid = seq_graphs[3]
+    y_valid = target_list[0]
+    #print(len(en_valid))
+    #print(len(X_valid))
+    en_test = energy_set[4]
+    X_test = seq_graphs[4]
+    y_test = target_list[4]
 
 #print(len(X_train),len(y_train),len(X_valid),len(y_valid),len(X_test),len(y_test))
 import torch
 from torch_geometric.data import InMemoryDataset, DataLoader, Batch
 from torch_geometric import data as DATA
+from graph_store import BudgetBatchSampler
+
+# graphs per batch are packed up to these totals instead of a fixed count, so memory does not
+# depend on how large the graphs of a batch happen to be
+MAX_BATCH_NODES = 150000
+MAX_BATCH_EDGES = 3000000
 seed_val = 42
 
 random.seed(seed_val)
@@ -327,6 +215,7 @@ def data_proccess(graph_data,y,en):
         #print(y[i])
         GCNData_pro = DATA.Data(x=torch.Tensor(graph_data[i][1]), en = torch.FloatTensor(en[i]),
                                     edge_index=torch.LongTensor(graph_data[i][2]).transpose(1, 0),
+                                    edge_weight=torch.from_numpy(normalized_edge_weight(np.asarray(graph_data[i][2]).T, graph_data[i][0])),
                                     y=torch.FloatTensor([y[i]]))
         GCNData_pro.__setitem__('target_size', torch.LongTensor([graph_data[i][0]]))
             
@@ -337,8 +226,8 @@ def data_proccess(graph_data,y,en):
     
     data_pro = data_list_pro
     
-    loader = torch.utils.data.DataLoader(data_pro, batch_size= 512,shuffle=False,
-                                              collate_fn=collate)
+    loader = torch.utils.data.DataLoader(data_pro, batch_sampler=BudgetBatchSampler.from_dataset(
+                                              data_pro, MAX_BATCH_NODES, MAX_BATCH_EDGES), collate_fn=collate)
     return loader
 
     
@@ -349,6 +238,7 @@ def test_data_proccess(graph_data,y,en):
         #print(y[i])
         GCNData_pro = DATA.Data(x=torch.Tensor(graph_data[i][1]), en = torch.FloatTensor(en[i]),
                                     edge_index=torch.LongTensor(graph_data[i][2]).transpose(1, 0),
+                                    edge_weight=torch.from_numpy(normalized_edge_weight(np.asarray(graph_data[i][2]).T, graph_data[i][0])),
                                     y=torch.FloatTensor([y[i]]))
         GCNData_pro.__setitem__('target_size', torch.LongTensor([graph_data[i][0]]))
             
@@ -359,8 +249,8 @@ def test_data_proccess(graph_data,y,en):
     
     data_pro = data_list_pro
     
-    loader = torch.utils.data.DataLoader(data_pro, batch_size= len(y),shuffle=False,
-                                              collate_fn=collate)
+    loader = torch.utils.data.DataLoader(data_pro, batch_sampler=BudgetBatchSampler.from_dataset(
+                                              data_pro, MAX_BATCH_NODES, MAX_BATCH_EDGES), collate_fn=collate)
 
     
     return loader
@@ -534,6 +424,9 @@ def train_project(net, optimizer, train_ldr, val_ldr, test_ldr,X_valid, epochs,
     if test_ldr != []:
 
         with torch.no_grad():
+            # the test set may span several budget batches, collect them before scoring
+            test_probs, test_preds, test_predsROC, test_targs = [], [], [], []
+            test_loss = 0
             for batch_idx, data in enumerate(test_ldr):
                 #print(batch_idx)
                 x_batch_test = data.to(device)
@@ -543,34 +436,36 @@ def train_project(net, optimizer, train_ldr, val_ldr, test_ldr,X_valid, epochs,
                 test_batch_loss = criterion(output, x_batch_test.y.view(-1, 1).float().to(device))
 
                 probs = torch.sigmoid(output.detach())
-                predsROC = probs
                 preds = np.round(probs.cpu())
-                test_probs = list(probs.data.cpu().numpy())
-                test_preds = list(preds.data.numpy())
-                test_predsROC = list(probs.data.cpu().numpy())
+                test_probs += list(probs.data.cpu().numpy())
+                test_preds += list(preds.data.numpy())
+                test_predsROC += list(probs.data.cpu().numpy())
                 #print("-----",test_predsROC)
-                test_targs = list(np.array(x_batch_test.y.view(-1, 1).float().to(device).cpu()))
-                test_loss = test_batch_loss.detach()
-                #print(x_batch_test.y)
-                test_auc_cur = roc_auc_score(test_targs, test_predsROC)
-                test_acc_cur = accuracy_score(test_targs, test_preds)
-                test_acc.append(test_acc_cur)
-                #print(test_acc)
-                test_auc.append(test_auc_cur)
+                test_targs += list(np.array(x_batch_test.y.view(-1, 1).float().to(device).cpu()))
+                test_loss += test_batch_loss.detach() * len(probs)
+            test_loss = test_loss / len(test_ldr.dataset)
+            #print(x_batch_test.y)
+            test_auc_cur = roc_auc_score(test_targs, test_predsROC)
+            test_acc_cur = accuracy_score(test_targs, test_preds)
+            test_acc.append(test_acc_cur)
+            #print(test_acc)
+            test_auc.append(test_auc_cur)
 
     return train_acc, train_losses, train_auc, valid_acc, valid_losses, valid_auc, val_preds, val_targs, test_preds, list(
         test_targs), test_loss, test_acc, test_auc
 
 # GCN based model
 class GNNNet(torch.nn.Module):
-    def __init__(self, n_output=1, num_features_pro=54, output_dim=128, dropout=0.5):
+    def __init__(self, n_output=1, num_features_pro=54, output_dim=128, dropout=0.5, normalized_adjacency=True):
         super(GNNNet, self).__init__()
 
-
+        # with normalized_adjacency the graphs carry precomputed GCN edge weights (graph_store.py),
+        # so the convolutions skip their own normalization of the static contact graphs
+        self.normalized_adjacency = normalized_adjacency
 
         # self.pro_conv1 = GCNConv(embed_dim, embed_dim)
-        self.pro_conv1 = GCNConv(num_features_pro, num_features_pro)
-        self.pro_conv2 = GCNConv(num_features_pro, num_features_pro * 2)
+        self.pro_conv1 = GCNConv(num_features_pro, num_features_pro, normalize=not normalized_adjacency)
+        self.pro_conv2 = GCNConv(num_features_pro, num_features_pro * 2, normalize=not normalized_adjacency)
         #self.pro_conv3 = GCNConv(num_features_pro * 2, num_features_pro * 4)
         # self.pro_conv4 = GCNConv(embed_dim * 4, embed_dim * 8)
         self.pro_fc_g1 = torch.nn.Linear(num_features_pro * 2, output_dim)
@@ -609,6 +504,7 @@ class GNNNet(torch.nn.Module):
         
         # get protein input
         target_x, target_edge_index, target_batch,en = data_pro.x, data_pro.edge_index, data_pro.batch,data_pro.en.float().detach().requires_grad_(True).unsqueeze(2)
+        target_edge_weight = data_pro.edge_weight if self.normalized_adjacency else None
         #print(en.size())
         #print(target_x.size())
         # target_seq=data_pro.target
@@ -620,12 +516,12 @@ class GNNNet(torch.nn.Module):
        
 
         
-        xt = self.pro_conv1(target_x, target_edge_index)
+        xt = self.pro_conv1(target_x, target_edge_index, target_edge_weight)
         xt = self.relu(xt)
         xt = self.dropout(xt)
         #print("xt", xt.size())
         # target_edge_index, _ = dropout_adj(target_edge_index, training=self.training)
-        xt = self.pro_conv2(xt, target_edge_index)
+        xt = self.pro_conv2(xt, target_edge_index, target_edge_weight)
         xt = self.relu(xt)
         xt = self.dropout(xt)
         #print("xt", xt.size())
@@ -729,7 +625,11 @@ if not os.path.exists(results_dir):
 result_str = ''
 USE_CUDA = torch.cuda.is_available()
 device = torch.device('cuda:10.2' if USE_CUDA else 'cpu')
-model = GNNNet()
+if graph_embedding is None:
+    model = GNNNet()
+else:
+    from graph_store import esm_features
+    model = GNNNet(num_features_pro=esm_features[graph_embedding])
 model.to(device)
 
 model_st = GNNNet.__name__
@@ -739,13 +639,26 @@ model_st = GNNNet.__name__
 
 optimizer = torch.optim.Adam(model.parameters(), lr=LR)
 
-#en_train_loader = torch.utils.data.DataLoader(en_train, batch_size= len(en_train),shuffle=False)
-train_loader = data_proccess(X_train,y_train,en_train)
-#print(train_loader)
-#en_valid_loader = torch.utils.data.DataLoader(en_valid, batch_size= len(en_valid),shuffle=False)
-valid_loader = data_proccess(X_valid,y_valid,en_valid)
-#en_test_loader = torch.utils.data.DataLoader(en_test, batch_size= len(en_test),shuffle=False)
-test_loader = test_data_proccess(X_test,y_test,en_test)
+if use_graph_store:
+    # one collated file per partition, written by graph_store.py on first use. Featurize them in parallel
+    # beforehand with python graph_store.py --workers N: this script has no __main__ guard, so it cannot
+    # start a spawn-context pool itself (the workers would re-run it)
+    from graph_store import GraphPartition
+    # GNN partitions 0-2 (P3, P4, P2) train, 3 (P1) validates and 4 (P5) tests, the split of the graphs built above
+    X_train = torch.utils.data.ConcatDataset([GraphPartition(p, embedding=graph_embedding) for p in range(3)])
+    X_valid = GraphPartition(3, embedding=graph_embedding)
+    X_test = GraphPartition(4, embedding=graph_embedding)
+    train_loader, valid_loader, test_loader = [
+        DataLoader(dataset, batch_sampler=BudgetBatchSampler.from_dataset(dataset, MAX_BATCH_NODES, MAX_BATCH_EDGES))
+        for dataset in [X_train, X_valid, X_test]]
+else:
+    #en_train_loader = torch.utils.data.DataLoader(en_train, batch_size= len(en_train),shuffle=False)
+    train_loader = data_proccess(X_train,y_train,en_train)
+    #print(train_loader)
+    #en_valid_loader = torch.utils.data.DataLoader(en_valid, batch_size= len(en_valid),shuffle=False)
+    valid_loader = data_proccess(X_valid,y_valid,en_valid)
+    #en_test_loader = torch.utils.data.DataLoader(en_test, batch_size= len(en_test),shuffle=False)
+    test_loader = test_data_proccess(X_test,y_test,en_test)
 
 
 epochs = 1
@@ -0,0 +1,211 @@
+# Packed GNN_data partitions.
+#
+# GNN_data/data_all/{m} holds one fasta, one aln and one dense pconsc4 contact map per complex,
+# thousands of small files per partition of which the maps are mostly unused (only entries >= 0.5
+# become edges). pack_partition writes a partition to one file instead:
+#
+#   magic | header length | JSON header | arrays, each 64-byte aligned
+#
+# with the sequences, the alignment of every distinct chain as a uint8 matrix of pro_res_table codes,
+# and the thresholded contact edges in CSR form, every group indexed by an offset array. GraphArchive
+# memory-maps the arrays and reads single complexes without touching the rest of the file.
+#
+#   python graph_archive.py                 (writes ../data/graphArchive/partition_{1..5}.gnnpack)
+#   python graph_archive.py --partitions 4 --threshold 0.5
+
+import os
+import json
+import struct
+import argparse
+import numpy as np
+
+from graph_features import read_alignment, alignment_pssm, seq_features, chain_adjacency
+
+gnn_dir = os.path.join('GNN_data', 'data_all')
+partition_sizes = [1480, 1532, 1168, 1526, 1207]
+archive_dir = '../data/graphArchive/'
+
+magic = b'GNNPACK1'
+array_alignment = 64
+
+
+def read_sequence(seq_file):
+    with open(seq_file) as f:
+        return ''.join(line.strip() for line in f if not line.startswith('>'))
+
+def archive_path(partition, archive_dir=archive_dir):
+    return os.path.join(archive_dir, 'partition_{}.gnnpack'.format(partition + 1))
+
+def write_pack(path, arrays, meta):
+    """
+    Write named numpy arrays and a JSON-serializable meta dict to one file.
+    """
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        offset = -(-offset // array_alignment) * array_alignment
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+    header = json.dumps({'meta': meta, 'arrays': layout}).encode()
+    data_start = -(-(len(magic) + 8 + len(header)) // array_alignment) * array_alignment
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+    return path
+
+def read_pack(path):
+    """
+    (meta, arrays) of a file written by write_pack, the arrays memory-mapped read-only.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("{} is not a packed GNN_data partition".format(path))
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length))
+    data_start = -(-(len(magic) + 8 + header_length) // array_alignment) * array_alignment
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        shape = tuple(entry['shape'])
+        if np.prod(shape) == 0:
+            # np.memmap cannot map an empty region
+            arrays[name] = np.zeros(shape, dtype=entry['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=entry['dtype'], mode='r',
+                                     offset=data_start + entry['offset'], shape=shape)
+    return header['meta'], arrays
+
+def offsets(sizes):
+    return np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]).astype(np.int64)
+
+def contact_csr(contact_map, threshold=0.5):
+    """
+    CSR (indptr, indices) of the residue pairs with a contact probability of at least threshold, plus self loops.
+    Same edges, in the same order, as graph_store.contact_edges.
+    """
+    mask = (contact_map + np.eye(contact_map.shape[0])) >= threshold
+    indptr = np.concatenate([[0], np.cumsum(mask.sum(axis=1))]).astype(np.int32)
+    indices = np.nonzero(mask)[1].astype(np.int16)
+    return indptr, indices
+
+def pack_partition(partition, gnn_dir=gnn_dir, out_dir=archive_dir, threshold=0.5, size=None):
+    """
+    Pack the sequences, alignments and contact edges of GNN_data partition partition (0-based) into one file.
+    """
+    partition_dir = os.path.join(gnn_dir, str(partition + 1))
+    size = partition_sizes[partition] if size is None else size
+
+    sequences, chain_ids, chains = [], [], {}
+    alignments, line_counts = [], []
+    indptrs, indices = [], []
+    for key in range(size):
+        sequence = read_sequence(os.path.join(partition_dir, 'seq', '{}.fasta'.format(key)))
+        sequences.append(np.frombuffer(sequence.encode(), dtype=np.uint8))
+        if sequence not in chains:
+            # complexes with the same chain share its alignment, like graph_features.pssm_cache
+            chains[sequence] = len(chains)
+            alignment, line_count = read_alignment(os.path.join(partition_dir, 'aln', '{}.aln'.format(key)), len(sequence))
+            alignments.append(alignment.ravel())
+            line_counts.append(line_count)
+        chain_ids.append(chains[sequence])
+        indptr, index = contact_csr(np.load(os.path.join(partition_dir, 'pconsc4', '{}.npy'.format(key))), threshold)
+        indptrs.append(indptr)
+        indices.append(index)
+
+    arrays = {'sequence_offsets': offsets([len(s) for s in sequences]),
+              'sequences': np.concatenate(sequences),
+              'chain_ids': np.array(chain_ids, dtype=np.int32),
+              'alignment_offsets': offsets([len(a) for a in alignments]),
+              'alignment_lines': np.array(line_counts, dtype=np.int64),
+              'alignments': np.concatenate(alignments),
+              'indptr_offsets': offsets([len(i) for i in indptrs]),
+              'indptr': np.concatenate(indptrs),
+              'edge_offsets': offsets([len(i) for i in indices]),
+              'indices': np.concatenate(indices)}
+    meta = {'partition': partition, 'complexes': size, 'chains': len(chains), 'threshold': threshold}
+    return write_pack(archive_path(partition, out_dir), arrays, meta)
+
+class GraphArchive:
+    """
+    Read-only view of a packed partition. chain_graph(key) returns the (size, node features, edge index,
+    edge weights) of graph_store.chain_graph without opening any GNN_data file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta, self.arrays = read_pack(path)
+        # PSSM per distinct chain
+        self.pssms = {}
+
+    def __len__(self):
+        return self.meta['complexes']
+
+    def _slice(self, name, i):
+        start, stop = self.arrays[name + '_offsets'][i:i+2]
+        return start, stop
+
+    def sequence(self, key):
+        start, stop = self._slice('sequence', key)
+        return self.arrays['sequences'][start:stop].tobytes().decode()
+
+    def alignment(self, key):
+        """
+        (rows x length uint8 matrix of pro_res_table codes, number of lines in the aln file) of a complex's chain.
+        """
+        chain = int(self.arrays['chain_ids'][key])
+        first, last = self._slice('sequence', key)
+        start, stop = self._slice('alignment', chain)
+        return self.arrays['alignments'][start:stop].reshape(-1, last - first), int(self.arrays['alignment_lines'][chain])
+
+    def contact_csr(self, key):
+        start, stop = self._slice('indptr', key)
+        indptr = self.arrays['indptr'][start:stop]
+        start, stop = self._slice('edge', key)
+        return indptr, self.arrays['indices'][start:stop]
+
+    def edge_index(self, key):
+        indptr, indices = self.contact_csr(key)
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        return np.stack([rows, indices]).astype(np.int64)
+
+    def pssm(self, key):
+        chain = int(self.arrays['chain_ids'][key])
+        if chain not in self.pssms:
+            self.pssms[chain] = alignment_pssm(*self.alignment(key))
+        return self.pssms[chain]
+
+    def chain_graph(self, key):
+        return self.chain_graphs([key])[0]
+
+    def chain_graphs(self, keys):
+        """
+        chain_graph of many complexes, with the residue features of all their sequences from one lookup.
+        """
+        keys = list(keys)
+        sequences = [self.sequence(key) for key in keys]
+        graphs = []
+        for key, sequence, residues in zip(keys, sequences, seq_features(sequences)):
+            features = np.concatenate((np.transpose(self.pssm(key), (1, 0)), residues), axis=1)
+            edge_index, edge_weight = chain_adjacency(sequence, lambda: self.edge_index(key))
+            graphs.append((len(sequence), features, edge_index, edge_weight))
+        return graphs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pack GNN_data partitions into one indexed file each.")
+    parser.add_argument('--partitions', type=int, nargs='+', default=list(range(5)), help="0-based partitions")
+    parser.add_argument('--gnn-dir', default=gnn_dir)
+    parser.add_argument('--output', default=archive_dir)
+    parser.add_argument('--threshold', type=float, default=0.5, help="contact probability of an edge")
+    args = parser.parse_args(argv)
+    for partition in args.partitions:
+        path = pack_partition(partition, args.gnn_dir, args.output, args.threshold)
+        archive = GraphArchive(path)
+        print("Partition {}: {} complexes, {} chains, {} edges, {:.1f} MB in {}".format(
+            partition + 1, len(archive), archive.meta['chains'], len(archive.arrays['indices']),
+            os.path.getsize(path) / 1e6, path))
+
+
+if __name__ == '__main__':
+    main()
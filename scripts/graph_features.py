@@ -0,0 +1,195 @@
+# Node features of the chain graphs used by graph.py, without graph.py's data loading and training
+# at import time.
+
+import numpy as np
+
+pro_res_table = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y',
+                 'X']
+
+# byte -> row of pro_res_table, len(pro_res_table) for characters outside the table (gaps)
+residue_codes = np.full(256, len(pro_res_table), dtype=np.uint8)
+for code, res in enumerate(pro_res_table):
+    residue_codes[ord(res)] = code
+
+# nomarlize
+def dic_normalize(dic):
+    # print(dic)
+    max_value = dic[max(dic, key=dic.get)]
+    min_value = dic[min(dic, key=dic.get)]
+    # print(max_value)
+    interval = float(max_value) - float(min_value)
+    for key in dic.keys():
+        dic[key] = (dic[key] - min_value) / interval
+    dic['X'] = (max_value + min_value) / 2.0
+    return dic
+
+
+pro_res_aliphatic_table = ['A', 'I', 'L', 'M', 'V']
+pro_res_aromatic_table = ['F', 'W', 'Y']
+pro_res_polar_neutral_table = ['C', 'N', 'Q', 'S', 'T']
+pro_res_acidic_charged_table = ['D', 'E']
+pro_res_basic_charged_table = ['H', 'K', 'R']
+
+res_weight_table = {'A': 71.08, 'C': 103.15, 'D': 115.09, 'E': 129.12, 'F': 147.18, 'G': 57.05, 'H': 137.14,
+                    'I': 113.16, 'K': 128.18, 'L': 113.16, 'M': 131.20, 'N': 114.11, 'P': 97.12, 'Q': 128.13,
+                    'R': 156.19, 'S': 87.08, 'T': 101.11, 'V': 99.13, 'W': 186.22, 'Y': 163.18}
+
+res_pka_table = {'A': 2.34, 'C': 1.96, 'D': 1.88, 'E': 2.19, 'F': 1.83, 'G': 2.34, 'H': 1.82, 'I': 2.36,
+                 'K': 2.18, 'L': 2.36, 'M': 2.28, 'N': 2.02, 'P': 1.99, 'Q': 2.17, 'R': 2.17, 'S': 2.21,
+                 'T': 2.09, 'V': 2.32, 'W': 2.83, 'Y': 2.32}
+
+res_pkb_table = {'A': 9.69, 'C': 10.28, 'D': 9.60, 'E': 9.67, 'F': 9.13, 'G': 9.60, 'H': 9.17,
+                 'I': 9.60, 'K': 8.95, 'L': 9.60, 'M': 9.21, 'N': 8.80, 'P': 10.60, 'Q': 9.13,
+                 'R': 9.04, 'S': 9.15, 'T': 9.10, 'V': 9.62, 'W': 9.39, 'Y': 9.62}
+
+res_pkx_table = {'A': 0.00, 'C': 8.18, 'D': 3.65, 'E': 4.25, 'F': 0.00, 'G': 0, 'H': 6.00,
+                 'I': 0.00, 'K': 10.53, 'L': 0.00, 'M': 0.00, 'N': 0.00, 'P': 0.00, 'Q': 0.00,
+                 'R': 12.48, 'S': 0.00, 'T': 0.00, 'V': 0.00, 'W': 0.00, 'Y': 0.00}
+
+res_pl_table = {'A': 6.00, 'C': 5.07, 'D': 2.77, 'E': 3.22, 'F': 5.48, 'G': 5.97, 'H': 7.59,
+                'I': 6.02, 'K': 9.74, 'L': 5.98, 'M': 5.74, 'N': 5.41, 'P': 6.30, 'Q': 5.65,
+                'R': 10.76, 'S': 5.68, 'T': 5.60, 'V': 5.96, 'W': 5.89, 'Y': 5.96}
+
+res_hydrophobic_ph2_table = {'A': 47, 'C': 52, 'D': -18, 'E': 8, 'F': 92, 'G': 0, 'H': -42, 'I': 100,
+                             'K': -37, 'L': 100, 'M': 74, 'N': -41, 'P': -46, 'Q': -18, 'R': -26, 'S': -7,
+                             'T': 13, 'V': 79, 'W': 84, 'Y': 49}
+res_hydrophobic_ph7_table = {'A': 41, 'C': 49, 'D': -55, 'E': -31, 'F': 100, 'G': 0, 'H': 8, 'I': 99,
+                             'K': -23, 'L': 97, 'M': 74, 'N': -28, 'P': -46, 'Q': -10, 'R': -14, 'S': -5,
+                             'T': 13, 'V': 76, 'W': 97, 'Y': 63}
+
+res_weight_table = dic_normalize(res_weight_table)
+res_pka_table = dic_normalize(res_pka_table)
+res_pkb_table = dic_normalize(res_pkb_table)
+res_pkx_table = dic_normalize(res_pkx_table)
+res_pl_table = dic_normalize(res_pl_table)
+res_hydrophobic_ph2_table = dic_normalize(res_hydrophobic_ph2_table)
+res_hydrophobic_ph7_table = dic_normalize(res_hydrophobic_ph7_table)
+
+# one ont encoding
+def one_of_k_encoding(x, allowable_set):
+    if x not in allowable_set:
+        # print(x)
+        raise Exception('input {0} not in allowable set{1}:'.format(x, allowable_set))
+    return list(map(lambda s: x == s, allowable_set))
+
+
+def one_of_k_encoding_unk(x, allowable_set):
+    '''Maps inputs not in the allowable set to the last element.'''
+    if x not in allowable_set:
+        #print(x)
+        x = allowable_set[-1]
+    return list(map(lambda s: x == s, allowable_set))
+
+def residue_features(residue):
+    res_property1 = [1 if residue in pro_res_aliphatic_table else 0, 1 if residue in pro_res_aromatic_table else 0,
+                     1 if residue in pro_res_polar_neutral_table else 0,
+                     1 if residue in pro_res_acidic_charged_table else 0,
+                     1 if residue in pro_res_basic_charged_table else 0]
+    res_property2 = [res_weight_table[residue], res_pka_table[residue], res_pkb_table[residue], res_pkx_table[residue],
+                     res_pl_table[residue], res_hydrophobic_ph2_table[residue], res_hydrophobic_ph7_table[residue]]
+    # print(np.array(res_property1 + res_property2).shape)
+    return np.array(res_property1 + res_property2)
+
+
+# one-hot and properties of every residue of pro_res_table, row i for code i
+residue_table = np.array([np.concatenate((one_of_k_encoding(res, pro_res_table), residue_features(res)))
+                          for res in pro_res_table], dtype=np.float64)
+
+
+def sequence_codes(pro_seq):
+    codes = residue_codes[np.frombuffer(pro_seq.encode(), dtype=np.uint8)]
+    unknown = np.flatnonzero(codes == len(pro_res_table))
+    if len(unknown):
+        raise Exception('input {0} not in allowable set{1}:'.format(pro_seq[unknown[0]], pro_res_table))
+    return codes
+
+def seq_feature(pro_seq):
+    """
+    One-hot and properties (length x 33) of a chain, one table lookup per residue.
+    """
+    return residue_table[sequence_codes(pro_seq)]
+
+def seq_features(sequences):
+    """
+    seq_feature of many chains with a single lookup over their concatenation.
+    """
+    features = residue_table[sequence_codes(''.join(sequences))]
+    return np.split(features, np.cumsum([len(seq) for seq in sequences])[:-1])
+
+
+# PSSM of every chain sequence computed so far, the same alignment is shared by every complex with that chain
+pssm_cache = {}
+
+
+def read_alignment(aln_file, length):
+    """
+    Read an .aln file once into a (lines x length) uint8 matrix of pro_res_table codes.
+    Lines whose length differs from the sequence are skipped. Also returns the number of lines in the file.
+    """
+    with open(aln_file, 'rb') as f:
+        lines = f.read().splitlines()
+    kept = [line for line in lines if len(line) == length]
+    if len(kept) < len(lines):
+        print('error', aln_file, len(lines) - len(kept), 'lines do not match the sequence length', length)
+    if not kept:
+        return np.zeros((0, length), dtype=np.uint8), len(lines)
+    alignment = residue_codes[np.frombuffer(b''.join(kept), dtype=np.uint8)].reshape(len(kept), length)
+    return alignment, len(lines)
+
+def alignment_pssm(alignment, line_count):
+    """
+    Position probability matrix (21 x length) of an alignment matrix from read_alignment, with a pseudocount.
+    """
+    length = alignment.shape[1]
+    # count (residue, position) pairs in one pass, gaps fall in the discarded last row
+    positions = np.broadcast_to(np.arange(length), alignment.shape)
+    pfm_mat = np.bincount((alignment.astype(np.int64) * length + positions).ravel(),
+                          minlength=(len(pro_res_table) + 1) * length)
+    pfm_mat = pfm_mat.reshape(len(pro_res_table) + 1, length)[:len(pro_res_table)]
+    pseudocount = 0.8
+    return (pfm_mat + pseudocount / 4) / (float(line_count) + pseudocount)
+
+def PSSM_calculation(aln_file, pro_seq):
+    """
+    Position probability matrix (21 x length) of the alignment of a chain, with a pseudocount.
+    """
+    if pro_seq in pssm_cache:
+        return pssm_cache[pro_seq]
+    pssm_mat = alignment_pssm(*read_alignment(aln_file, len(pro_seq)))
+    pssm_cache[pro_seq] = pssm_mat
+    return pssm_mat
+
+# (edge index, normalized edge weights) of every chain seen so far, the contact graph of a chain is the same
+# in every complex with that chain
+adjacency_cache = {}
+
+
+def normalized_edge_weight(edge_index, num_nodes):
+    """
+    Weights of D^-1/2 A D^-1/2 for the edges (2 x edges, self loops included), as GCNConv normalizes them.
+    """
+    row, col = edge_index
+    deg = np.bincount(col, minlength=num_nodes).astype(np.float64)
+    deg_inv_sqrt = np.zeros_like(deg)
+    deg_inv_sqrt[deg > 0] = deg[deg > 0] ** -0.5
+    return (deg_inv_sqrt[row] * deg_inv_sqrt[col]).astype(np.float32)
+
+def chain_adjacency(pro_seq, load_edges):
+    """
+    Edge index and normalized edge weights of a chain, load_edges() is only called the first time the chain is seen.
+    """
+    if pro_seq not in adjacency_cache:
+        edge_index = load_edges()
+        adjacency_cache[pro_seq] = (edge_index, normalized_edge_weight(edge_index, len(pro_seq)))
+    return adjacency_cache[pro_seq]
+
+def target_feature(aln_file, pro_seq):
+    pssm = PSSM_calculation(aln_file, pro_seq)
+    other_feature = seq_feature(pro_seq)
+    # print('target_feature')
+    # print(pssm.shape)
+    # print(other_feature.shape)
+
+    # print(other_feature.shape)
+    # return other_feature
+    return np.concatenate((np.transpose(pssm, (1, 0)), other_feature), axis=1)
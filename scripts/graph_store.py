@@ -0,0 +1,309 @@
+# Precomputed graph dataset for the GNN of graph.py.
+#
+# Every complex of a partition becomes a torch_geometric Data object (chain graph features, contact
+# edges, energy terms and target), and each partition is collated once into one file of tensors plus
+# slice indices (InMemoryDataset). Training then starts with a single torch.load per partition.
+#
+#   python graph_store.py                 (writes ../data/graphStore/processed/partition_{1..5}.pt)
+#   python graph_store.py --archive ../data/graphArchive/     (reads the packed partitions instead)
+#   python graph_store.py --workers 16    (featurizes all partitions over a process pool)
+#   python graph_store.py --embedding esm-1b  (ESM nodes and contact edges, processed/partition_{m}_esm-1b.pt)
+#
+# The GNN_data partitions are not in npz order: GNN partitions 1..5 (GNN_data/data_all/m) hold the
+# chains of P3, P4, P2, P1 and P5 (load_partitions order, P1..P4 of train/, P5 of validation/), see
+# npz_partitions.
+
+import os
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from torch_geometric.data import InMemoryDataset
+from torch_geometric import data as DATA
+
+import functions as func
+from graph_features import target_feature, chain_adjacency, normalized_edge_weight
+from graph_archive import gnn_dir, partition_sizes, read_sequence, archive_path, GraphArchive
+
+graph_root = '../data/graphStore/'
+
+# npz partition (index into load_partitions) of every GNN partition (0-based)
+npz_partitions = [2, 3, 1, 0, 4]
+
+# node features of the graphs of an ESM embedding
+esm_features = {'esm-1b': 1280, 'esm_ASM': 768}
+
+# npz partitions and labels, read once per process
+raw_partitions = {}
+
+
+def contact_edges(contact_map, threshold=0.5):
+    """
+    Edge index (2 x edges) of the residue pairs with a contact probability of at least threshold, plus self loops.
+    """
+    contact_map = contact_map + np.eye(contact_map.shape[0])
+    return np.argwhere(contact_map >= threshold).T.astype(np.int64)
+
+def chain_graph(partition, key, gnn_dir=gnn_dir):
+    """
+    (size, node features, edge index, normalized edge weights) of complex key of a partition (0-based),
+    like graph.target_to_graph. The contact map of a chain is read and normalized once per process.
+    """
+    partition_dir = os.path.join(gnn_dir, str(partition + 1))
+    sequence = read_sequence(os.path.join(partition_dir, 'seq', '{}.fasta'.format(key)))
+    features = target_feature(os.path.join(partition_dir, 'aln', '{}.aln'.format(key)), sequence)
+    edge_index, edge_weight = chain_adjacency(
+        sequence, lambda: contact_edges(np.load(os.path.join(partition_dir, 'pconsc4', '{}.npy'.format(key)))))
+    return len(sequence), features, edge_index, edge_weight
+
+def esm_graphs(sequences, embedding, threshold=0.5, batch_size=8):
+    """
+    (size, ESM representations, contact edge index, normalized edge weights) of every sequence. The representations and the contact
+    map of a sequence come from the same ESM forward pass, each distinct sequence is embedded once.
+    """
+    from encoding import embed_sequences
+    distinct = list(dict.fromkeys(sequences))
+    embedded, contacts = embed_sequences(distinct, embedding, batch_size, pad_to=None, return_contacts=True)
+    graphs = {}
+    for seq, representation, contact_map in zip(distinct, embedded, contacts):
+        edge_index = contact_edges(contact_map, threshold)
+        graphs[seq] = (len(seq), representation, edge_index, normalized_edge_weight(edge_index, len(seq)))
+    return [graphs[seq] for seq in sequences]
+
+def energy_terms(complexes):
+    """
+    Energy terms of raw complexes padded to 420 rows, (n, 420, 34).
+    """
+    energies = func.extract_energy_terms(complexes)
+    return np.stack([np.pad(en, ((0, 420 - len(en)), (0, 0)), 'constant') for en in energies]).astype(np.float32)
+
+def to_data(graph, en, y):
+    size, features, edge_index, edge_weight = graph
+    data = DATA.Data(x=torch.as_tensor(features, dtype=torch.float32),
+                     edge_index=torch.as_tensor(edge_index, dtype=torch.long),
+                     edge_weight=torch.as_tensor(edge_weight, dtype=torch.float32),
+                     en=torch.as_tensor(en, dtype=torch.float32),
+                     y=torch.FloatTensor([y]))
+    data.target_size = torch.LongTensor([size])
+    return data
+
+def partition_data(partition):
+    """
+    Raw complexes and labels of the npz partition holding the complexes of GNN partition partition.
+    """
+    if not raw_partitions:
+        data_list, target_list = func.load_partitions()
+        raw_partitions.update({p: (data, targets) for p, (data, targets) in enumerate(zip(data_list, target_list))})
+    complexes, targets = raw_partitions[npz_partitions[partition]]
+    assert len(targets) == partition_sizes[partition], \
+        "GNN partition {} has {} complexes but npz partition P{} has {}".format(
+            partition + 1, partition_sizes[partition], npz_partitions[partition] + 1, len(targets))
+    return complexes, targets
+
+def build_partition(partition, gnn_dir=gnn_dir, archive_dir=None, embedding=None):
+    """
+    Data objects of all complexes of a partition, read from its packed archive (graph_archive.py)
+    when archive_dir is given and from the GNN_data files otherwise. With an ESM embedding, the nodes
+    get the ESM representations and the edges come from ESM's contact predictions instead of
+    the PSSM features and pconsc4 maps.
+    """
+    keys = range(partition_sizes[partition])
+    if archive_dir is not None:
+        archive = GraphArchive(archive_path(partition, archive_dir))
+    if embedding is not None:
+        if archive_dir is not None:
+            sequences = [archive.sequence(key) for key in keys]
+        else:
+            partition_dir = os.path.join(gnn_dir, str(partition + 1))
+            sequences = [read_sequence(os.path.join(partition_dir, 'seq', '{}.fasta'.format(key))) for key in keys]
+        graphs = esm_graphs(sequences, embedding)
+    elif archive_dir is not None:
+        graphs = archive.chain_graphs(keys)
+    else:
+        graphs = (chain_graph(partition, key, gnn_dir) for key in keys)
+    return to_data_list(partition, graphs)
+
+def to_data_list(partition, graphs):
+    """
+    Data objects of the chain graphs of a partition, in key order, with their energy terms and labels.
+    """
+    complexes, targets = partition_data(partition)
+    en = energy_terms(complexes)
+    return [to_data(graph, en[key], targets[key]) for key, graph in enumerate(graphs)]
+
+# GNN_data location of the current pool worker, set once by init_worker
+worker_source = {}
+
+def init_worker(gnn_dir, archive_dir):
+    worker_source.update({'gnn_dir': gnn_dir, 'archive_dir': archive_dir, 'archives': {}})
+
+def featurize_item(item):
+    """
+    chain_graph of one (partition, key) work item in a pool worker.
+    """
+    partition, key = item
+    if worker_source['archive_dir'] is None:
+        return chain_graph(partition, key, worker_source['gnn_dir'])
+    archives = worker_source['archives']
+    if partition not in archives:
+        archives[partition] = GraphArchive(archive_path(partition, worker_source['archive_dir']))
+    return archives[partition].chain_graph(key)
+
+def featurize_parallel(items, gnn_dir=gnn_dir, archive_dir=None, n_workers=None, chunksize=64, report_every=1000):
+    """
+    Chain graphs of (partition, key) work items over a process pool, returned in the order of items.
+    Work is handed out in chunks of consecutive keys, so complexes sharing a chain mostly hit the
+    same worker's PSSM cache.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    graphs = []
+    start = time.perf_counter()
+    # spawn, since forking a process that already started torch's thread pools can deadlock
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(gnn_dir, archive_dir)) as pool:
+        for graph in pool.map(featurize_item, items, chunksize=chunksize):
+            graphs.append(graph)
+            if len(graphs) % report_every == 0 or len(graphs) == len(items):
+                elapsed = time.perf_counter() - start
+                print("{}/{} graphs featurized, {:.1f} items/s".format(len(graphs), len(items), len(graphs) / elapsed))
+    return graphs
+
+def write_partitions(partitions, root=graph_root, gnn_dir=gnn_dir, archive_dir=None, n_workers=None, overwrite=False):
+    """
+    Featurize the complexes of several partitions in one process pool and write each partition
+    to the store, where GraphPartition loads it. Partitions already in the store are skipped
+    unless overwrite.
+    """
+    partitions = [p for p in partitions if overwrite or not os.path.exists(processed_path(p, root))]
+    items = [(partition, key) for partition in partitions for key in range(partition_sizes[partition])]
+    if not items:
+        return []
+    graphs = featurize_parallel(items, gnn_dir, archive_dir, n_workers)
+    os.makedirs(os.path.join(root, 'processed'), exist_ok=True)
+    start = 0
+    for partition in partitions:
+        stop = start + partition_sizes[partition]
+        data_list = to_data_list(partition, graphs[start:stop])
+        torch.save(InMemoryDataset.collate(data_list), processed_path(partition, root))
+        start = stop
+    return partitions
+
+def graph_sizes(dataset):
+    """
+    Number of nodes and of edges of every graph of a dataset, from the slices of collated
+    partitions without touching the graphs.
+    """
+    if isinstance(dataset, torch.utils.data.ConcatDataset):
+        sizes = [graph_sizes(part) for part in dataset.datasets]
+        return np.concatenate([s[0] for s in sizes]), np.concatenate([s[1] for s in sizes])
+    if isinstance(dataset, InMemoryDataset):
+        return np.diff(dataset.slices['x'].numpy()), np.diff(dataset.slices['edge_index'].numpy())
+    return np.array([data.num_nodes for data in dataset]), np.array([data.num_edges for data in dataset])
+
+class BudgetBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of consecutive graphs (in a per-epoch shuffled order if shuffle) with at most
+    max_nodes nodes and max_edges edges in total. A graph over either budget gets a batch of its own.
+    """
+    def __init__(self, nodes, edges, max_nodes, max_edges=None, shuffle=False, seed=0):
+        self.nodes = np.asarray(nodes)
+        self.edges = np.asarray(edges)
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges if max_edges is not None else np.inf
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    @classmethod
+    def from_dataset(cls, dataset, max_nodes, max_edges=None, shuffle=False, seed=0):
+        nodes, edges = graph_sizes(dataset)
+        return cls(nodes, edges, max_nodes, max_edges, shuffle, seed)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.nodes))
+        else:
+            order = np.arange(len(self.nodes))
+        batch, nodes, edges = [], 0, 0
+        for i in order:
+            if batch and (nodes + self.nodes[i] > self.max_nodes or edges + self.edges[i] > self.max_edges):
+                yield batch
+                batch, nodes, edges = [], 0, 0
+            batch.append(int(i))
+            nodes += self.nodes[i]
+            edges += self.edges[i]
+        if batch:
+            yield batch
+
+    def __iter__(self):
+        return self.batches()
+
+    def __len__(self):
+        # the number of batches depends on the order, count it for the current epoch
+        return sum(1 for _ in self.batches())
+
+def processed_name(partition, embedding=None):
+    if embedding is not None:
+        return 'partition_{}_{}.pt'.format(partition + 1, embedding)
+    return 'partition_{}.pt'.format(partition + 1)
+
+def processed_path(partition, root=graph_root, embedding=None):
+    return os.path.join(root, 'processed', processed_name(partition, embedding))
+
+class GraphPartition(InMemoryDataset):
+    """
+    One partition of the graph dataset, built from GNN_data on first use and loaded
+    from root/processed/partition_{partition+1}.pt afterwards.
+    """
+    def __init__(self, partition, root=graph_root, gnn_dir=gnn_dir, transform=None, archive_dir=None, embedding=None):
+        self.partition = partition
+        self.gnn_dir = gnn_dir
+        self.archive_dir = archive_dir
+        self.embedding = embedding
+        super(GraphPartition, self).__init__(root, transform)
+        self.data, self.slices = torch.load(self.processed_paths[0], weights_only=False)
+        if 'edge_weight' not in self.slices:
+            # written before the normalized edge weights were stored
+            self.process()
+            self.data, self.slices = torch.load(self.processed_paths[0], weights_only=False)
+
+    @property
+    def raw_file_names(self):
+        return []
+
+    @property
+    def processed_file_names(self):
+        return [processed_name(self.partition, self.embedding)]
+
+    def download(self):
+        pass
+
+    def process(self):
+        torch.save(self.collate(build_partition(self.partition, self.gnn_dir, self.archive_dir, self.embedding)), self.processed_paths[0])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the collated graph dataset of every partition.")
+    parser.add_argument('--partitions', type=int, nargs='+', default=list(range(5)), help="0-based partitions")
+    parser.add_argument('--root', default=graph_root)
+    parser.add_argument('--archive', help="directory of packed partitions written by graph_archive.py")
+    parser.add_argument('--embedding', help="esm-1b or esm_ASM: ESM representations and contacts instead of PSSM and pconsc4")
+    parser.add_argument('--workers', type=int, help="featurize over a pool of this many processes")
+    args = parser.parse_args(argv)
+    if args.workers and args.embedding is None:
+        write_partitions(args.partitions, args.root, gnn_dir, args.archive, args.workers)
+    for partition in args.partitions:
+        dataset = GraphPartition(partition, args.root, archive_dir=args.archive, embedding=args.embedding)
+        print("Partition {}: {} graphs, {} nodes, {} edges".format(
+            partition + 1, len(dataset), dataset.data.x.shape[0], dataset.data.edge_index.shape[1]))
+
+
+if __name__ == '__main__':
+    main()
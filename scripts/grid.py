@@ -0,0 +1,158 @@
+# In-process hyperparameter grid executor.
+#
+# Instead of one papermill notebook (fresh kernel, imports, data loading) per configuration,
+# the data of every embedding in the grid is written once to a memory-mapped partition store
+# and the configurations run as tasks of a process pool with a fixed number of torch threads
+# per worker. Results are logged to the mlflow experiment with the parameter names of main3.ipynb.
+
+import os
+import time
+import itertools
+import multiprocessing
+import pandas as pd
+import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import functions as func
+
+
+# partition stores opened by the current worker process, by directory
+stores = {}
+
+def init_worker(threads):
+    """
+    Pin the torch threads of a pool worker.
+    """
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+def open_store(store_dir):
+    """
+    Memory-map a partition store once per worker process.
+    """
+    if store_dir not in stores:
+        stores[store_dir] = func.load_partition_store(store_dir)
+    return stores[store_dir]
+
+def expand_grid(esm_1b_separated, embedding, numHN, numFilter, learning_rate, weight_decay, dropOutRate,
+                modelName=['Net_project'], keep_energy=True):
+    """
+    All configurations of the grid, in the loop order of runner3.py
+    (esm_ASM has no separated encoding, so those combinations are skipped).
+    """
+    configs = []
+    for sep, emb, mN, nn, nf, lr, wd, do in itertools.product(esm_1b_separated, embedding, modelName, numHN,
+                                                               numFilter, learning_rate, weight_decay, dropOutRate):
+        if emb == 'esm_ASM' and sep == True:
+            continue
+        configs.append({'esm_1b_separated': sep,
+                        'embedding': emb,
+                        'keep_energy': keep_energy and not sep,
+                        'modelName': mN,
+                        'numHN': nn,
+                        'numFilter': nf,
+                        'learning_rate': lr,
+                        'weight_decay': wd,
+                        'dropOutRate': do})
+    return configs
+
+def train_config(store_dir, config):
+    """
+    Train and test one configuration in a pool worker.
+    """
+    start = time.time()
+    X, y, offsets = open_store(store_dir)
+    result = func.train_on_store(X, y, offsets, config)
+    result['minutes'] = (time.time() - start) / 60
+    return result
+
+# main3.ipynb logs 'test AUC' from the rounded predictions, train_on_store computes it from the
+# probabilities, so it gets its own name in the shared experiments
+mlflow_metric_names = {'test AUC': 'test AUC (probabilities)'}
+
+def log_mlflow(config, result, name_experiment, tags=None, metrics=None):
+    """
+    Log one finished configuration like the last cell of main3.ipynb, plus optional
+    tags and extra metrics (dicts).
+    """
+    import mlflow
+
+    mlflow.set_experiment(name_experiment)
+    with mlflow.start_run():
+        if tags:
+            mlflow.set_tags(tags)
+        mlflow.log_param('embedding', config['embedding'])
+        mlflow.log_param('esm_1b_separated', str(config['esm_1b_separated']))
+        mlflow.log_param('model', config['modelName'])
+        mlflow.log_param('Hidden Neurons', config['numHN'])
+        mlflow.log_param('filters CNN', config['numFilter'])
+        mlflow.log_param('Dropout rate', config['dropOutRate'])
+        mlflow.log_param('learning rate', config['learning_rate'])
+        mlflow.log_param('Weight decay', config['weight_decay'])
+
+        for metric in ['test AUC', 'test MCC', 'test ACC', 'train ACC', 'train AUC', 'valid ACC', 'valid AUC']:
+            mlflow.log_metric(mlflow_metric_names.get(metric, metric), result[metric])
+        for metric, value in (metrics or {}).items():
+            mlflow.log_metric(metric, value)
+
+def prepare_tasks(configs, store_root='../data/partitionStore/'):
+    """
+    Complete every configuration with the default parameters and pair it with its partition
+    store. The store of each (embedding, energy, separated) combination is prepared once.
+    """
+    tasks = []
+    store_dirs = {}
+    for config in configs:
+        run_config = dict(func.default_config)
+        run_config.update(config)
+        run_config['checkpoint'] = None
+        key = (run_config['embedding'], run_config['keep_energy'], run_config['esm_1b_separated'])
+        if key not in store_dirs:
+            store_dirs[key] = func.partition_store(*key, store_root=store_root)
+        tasks.append((store_dirs[key], run_config))
+    return tasks
+
+def run_grid(configs, n_workers=None, threads_per_worker=2, name_experiment="hyperparameter grid",
+             store_root='../data/partitionStore/'):
+    """
+    Run every configuration as a task of one process pool, after preparing the data
+    of the grid once. Only the parent process writes to mlflow, as results come in.
+    A configuration that raises is reported and skipped, the others keep running.
+    """
+    if n_workers is None:
+        n_workers = max(1, os.cpu_count() // threads_per_worker)
+
+    tasks = prepare_tasks(configs, store_root)
+
+    rows = []
+    failed = []
+    start = time.time()
+    # spawn, since forking a process that already started torch's thread pools can deadlock
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(threads_per_worker,)) as pool:
+        futures = {pool.submit(train_config, store_dir, run_config): run_config for store_dir, run_config in tasks}
+        for future in as_completed(futures):
+            run_config = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed.append(run_config)
+                print("Failed {}: {}: {}".format(run_config, type(e).__name__, e))
+                continue
+            if name_experiment:
+                log_mlflow(run_config, result, name_experiment)
+
+            row = {key: run_config[key] for key in ['embedding', 'esm_1b_separated', 'modelName', 'numHN', 'numFilter',
+                                                    'dropOutRate', 'learning_rate', 'weight_decay']}
+            row.update(result)
+            rows.append(row)
+            print("Done {}/{} in {} mins: {}".format(len(rows), len(tasks), round((time.time()-start)/60, 2), row))
+
+    if failed:
+        print("{} of {} configurations failed".format(len(failed), len(tasks)))
+    return pd.DataFrame(rows)
@@ -1,19 +1,11 @@
 #this has been taken from Paolos link
 
-import glob
-# TESTING
-import pandas as pd
 import numpy as np
 import random
-import matplotlib.pyplot as plt
-from sklearn import metrics
-from sklearn.metrics import f1_score, accuracy_score
-from sklearn.metrics import roc_curve, confusion_matrix
 import torch
 import torch.nn as nn  # All neural network modules, nn.Linear, nn.Conv2d, BatchNorm, Loss functions
 import torch.optim as optim  # For all Optimization algorithms, SGD, Adam, etc.
 import torch.nn.functional as F  # All functions that don’t have any parameters
-from sklearn.metrics import accuracy_score
 
 seed_val = 1
 random.seed(seed_val)
@@ -82,7 +74,7 @@ class Net_thesis(nn.Module):
         x = self.pool(F.relu(self.conv2(x)))
         x = self.conv2_bn(x)
         x = self.drop(x)
-        x = x.transpose_(2, 1)
+        x = x.transpose(2, 1)
         x, (h, c) = self.rnn(x)
         cat = torch.cat((h[-2, :, :], h[-1, :, :]), dim=1)
         cat = self.drop(cat)
@@ -118,7 +110,7 @@ class Net_project(nn.Module):
         x = self.pool(F.relu(self.conv2(x)))
         x = self.conv2_bn(x)
         x = self.drop(x)
-        x = x.transpose_(2, 1)
+        x = x.transpose(2, 1)
         x, (h, c) = self.rnn(x)
         cat = torch.cat((h[-2, :, :], h[-1, :, :]), dim=1)
         cat = self.drop(cat)
@@ -162,7 +154,7 @@ class Net_project2(nn.Module):
         x = self.drop(x)
         x = self.pool(F.relu(self.conv2(3)))
         x = self.drop(x)
-        x = x.transpose_(2, 1)
+        x = x.transpose(2, 1)
         x, (h, c) = self.rnn(x)
         cat = torch.cat((h[-2, :, :], h[-1, :, :]), dim=1)
         cat = self.drop(cat)
@@ -209,7 +201,7 @@ class Net_project3(nn.Module):
         x = self.drop(x)
         x = self.pool(F.relu(self.conv3(x)))
         x = self.drop(x)
-        x = x.transpose_(2, 1)
+        x = x.transpose(2, 1)
         x, (h, c) = self.rnn(x)
         cat = torch.cat((h[-2, :, :], h[-1, :, :]), dim=1)
         cat = self.drop(cat)
@@ -259,7 +251,7 @@ class Net_project4(nn.Module):
         x = self.drop(x)
         x = self.pool(F.relu(self.conv2(x)))
         x = self.drop(x)
-        x = x.transpose_(2, 1)
+        x = x.transpose(2, 1)
         x, (h, c) = self.rnn(x)
         cat = torch.cat((h[-2, :, :], h[-1, :, :]), dim=1)
         cat = self.drop(cat)
@@ -267,4 +259,45 @@ class Net_project4(nn.Module):
         x = self.ln_bn(x)
         x = self.drop(x)
         x = self.fc2(x)
-        return x
\ No newline at end of file
+        return x
+
+models = {"Net": Net,
+          "Net_project": Net_project,
+          "Net_project2": Net_project2,
+          "Net_project3": Net_project3,
+          "Net_project4": Net_project4}
+
+def build_model(modelName, n_features, numHN, numFilter, dropOutRate, num_classes=1):
+    """
+    Initialize one of the networks above from its name and hyperparameters,
+    the same way the notebooks do.
+    """
+    if modelName not in models:
+        raise ValueError("Unknown model {}, choose from {}".format(modelName, list(models)))
+    if modelName == "Net":
+        return Net(num_classes=num_classes)
+    return models[modelName](num_classes=num_classes,
+                             n_features=n_features,
+                             numHN=numHN,
+                             numFilter=numFilter,
+                             dropOutRate=dropOutRate)
+
+def infer_hyperparameters(state_dict):
+    """
+    Recover n_features, numFilter and numHN of a saved network from its weight shapes.
+    """
+    return {'n_features': state_dict['bn0.weight'].shape[0],
+            'numFilter': state_dict['conv1.weight'].shape[0],
+            'numHN': state_dict['rnn.weight_hh_l0'].shape[1] if 'rnn.weight_hh_l0' in state_dict else None}
+
+def load_checkpoint(path, modelName="Net_project"):
+    """
+    Rebuild a network from a state dict saved during training (e.g. EarlyStopping's checkpoint.pt),
+    in eval mode. Dropout does not matter for inference, so it is not needed.
+    """
+    state_dict = torch.load(path, map_location='cpu')
+    hp = infer_hyperparameters(state_dict)
+    net = build_model(modelName, hp['n_features'], hp['numHN'], hp['numFilter'], 0.0)
+    net.load_state_dict(state_dict)
+    net.eval()
+    return net
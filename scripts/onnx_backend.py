@@ -0,0 +1,170 @@
+# ONNX export and onnxruntime inference.
+#
+# Exports Net, Net_project and Net_project3 with a dynamic batch axis (and a dynamic residue axis,
+# except for Net whose fc1 fixes the length to 420), and serves them through OnnxBackend, which has
+# the same predict_proba interface as predict.TorchBackend. The parity suite compares both runtimes
+# on random and all-zero (padding) inputs over several batch sizes and lengths.
+#
+#   python onnx_backend.py --model Net Net_project Net_project3            (randomly initialized)
+#   python onnx_backend.py --checkpoint checkpoint.pt --model Net_project --output net_project.onnx
+#
+# needs: pip install onnx onnxruntime
+
+import os
+import time
+import inspect
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+
+from model import Net, build_model, load_checkpoint
+from predict import TorchBackend
+
+exportable = ["Net", "Net_project", "Net_project3"]
+
+
+def export_onnx(net, path, n_features, opset=17):
+    """
+    Export a network in eval mode to ONNX. The model input is (batch, features, residues) like
+    for the torch network; whether the output is already a probability is stored in the metadata.
+    """
+    import onnx
+    net = net.eval()
+    dynamic_axes = {'input': {0: 'batch'}, 'output': {0: 'batch'}}
+    if not isinstance(net, Net):
+        dynamic_axes['input'][2] = 'residues'
+    # the dynamo exporter, the default on recent torch, cannot export the LSTM networks with a
+    # dynamic residues axis; the TorchScript exporter can
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(net, torch.randn(2, n_features, 420), path, input_names=['input'], output_names=['output'],
+                          dynamic_axes=dynamic_axes, opset_version=opset, **options)
+
+    model = onnx.load(path)
+    entry = model.metadata_props.add()
+    entry.key, entry.value = 'outputs_probabilities', str(isinstance(net, Net))
+    onnx.save(model, path)
+    return path
+
+class OnnxBackend:
+    """
+    Inference with onnxruntime on CPU. predict_proba takes complexes in the
+    (n, residues, features) layout of the data files and returns probabilities.
+    """
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.outputs_probabilities = metadata.get('outputs_probabilities') == 'True'
+
+    def predict_proba(self, x):
+        output = self.session.run(['output'], {'input': np.ascontiguousarray(np.transpose(x, (0, 2, 1)), dtype=np.float32)})[0]
+        if not self.outputs_probabilities:
+            output = 1 / (1 + np.exp(-output))
+        return output.ravel()
+
+def min_length(net, n_features, max_length=420):
+    """
+    Shortest residue axis a network accepts (its poolings need at least one position left), by bisection.
+    """
+    def runs(length):
+        try:
+            with torch.no_grad():
+                net(torch.zeros(1, n_features, length))
+            return True
+        except RuntimeError:
+            return False
+
+    low, high = 1, max_length
+    while low < high:
+        mid = (low + high) // 2
+        if runs(mid):
+            high = mid
+        else:
+            low = mid + 1
+    return low
+
+def parity_suite(torch_backend, onnx_backend, n_features, fixed_length, batch_sizes=(1, 7, 64),
+                 lengths=(420, 301, 97), atol=1e-5):
+    """
+    Compare the probabilities of both backends on random and all-zero inputs. Returns one row per case
+    and raises an AssertionError listing the cases above atol. Lengths below the shortest input the
+    network accepts are skipped.
+    """
+    if fixed_length:
+        lengths = (420,)
+    else:
+        shortest = min_length(torch_backend.net, n_features)
+        lengths = [length for length in lengths if length >= shortest]
+    rng = np.random.default_rng(0)
+    rows = []
+    for length in lengths:
+        for batch_size in batch_sizes:
+            for kind in ['random', 'zeros']:
+                if kind == 'random':
+                    x = rng.standard_normal((batch_size, length, n_features), dtype=np.float32)
+                else:
+                    x = np.zeros((batch_size, length, n_features), dtype=np.float32)
+                diff = np.abs(torch_backend.predict_proba(x) - onnx_backend.predict_proba(x)).max()
+                rows.append({'residues': length, 'batch size': batch_size, 'input': kind,
+                             'max abs diff': float(diff), 'passed': bool(diff <= atol)})
+    results = pd.DataFrame(rows)
+    failed = results[~results['passed']]
+    if len(failed):
+        raise AssertionError("ONNX output differs from torch:\n" + failed.to_string(index=False))
+    return results
+
+def throughput(backends, n_features, batch_sizes=(1, 32, 128), seconds=3.0):
+    """
+    Complexes per second of every backend of a dict for full-length (420 residue) batches.
+    """
+    rng = np.random.default_rng(0)
+    rows = []
+    for batch_size in batch_sizes:
+        x = rng.standard_normal((batch_size, 420, n_features), dtype=np.float32)
+        row = {'batch size': batch_size}
+        for name, backend in backends.items():
+            backend.predict_proba(x)   # warmup
+            n, start = 0, time.perf_counter()
+            while time.perf_counter() - start < seconds:
+                backend.predict_proba(x)
+                n += batch_size
+            row[name + ' complexes/s'] = n / (time.perf_counter() - start)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export networks to ONNX, check parity with torch and compare throughput.")
+    parser.add_argument('--checkpoint', help="state dict saved during training, randomly initialized networks otherwise")
+    parser.add_argument('--model', nargs='+', default=["Net_project"], choices=exportable)
+    parser.add_argument('--n-features', type=int, default=54, help="input features of randomly initialized networks")
+    parser.add_argument('--output', default=None, help="ONNX file (default <model>.onnx)")
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--seconds', type=float, default=3.0, help="duration of every throughput measurement")
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    for modelName in args.model:
+        if args.checkpoint:
+            net = load_checkpoint(args.checkpoint, modelName)
+        else:
+            net = build_model(modelName, args.n_features, numHN=32, numFilter=100, dropOutRate=0.0).eval()
+        n_features = net.bn0.num_features
+        path = args.output if args.output and len(args.model) == 1 else '{}.onnx'.format(modelName)
+
+        export_onnx(net, path, n_features)
+        print("Exported {} to {} ({:.1f} MB)".format(modelName, path, os.path.getsize(path) / 1e6))
+        backends = {'torch': TorchBackend(net), 'onnxruntime': OnnxBackend(path, args.threads)}
+
+        print(parity_suite(backends['torch'], backends['onnxruntime'], n_features, isinstance(net, Net)).to_string(index=False))
+        print(throughput(backends, n_features, seconds=args.seconds).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
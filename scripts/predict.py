@@ -0,0 +1,205 @@
+# Batch prediction with a trained network.
+#
+# Loads a checkpoint saved during training together with its embedding settings, streams
+# npz partitions (raw complexes) or .npy files (already embedded complexes) in bounded chunks
+# and appends the predictions to a CSV or Parquet file as they are computed.
+#
+#   python predict.py --checkpoint checkpoint.pt --model Net_project --embedding Baseline \
+#                     --input ../data/validation/P5_input.npz --output predictions.csv
+
+import os
+import sys
+import json
+import time
+import glob
+import zipfile
+import resource
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+
+import functions as func
+from model import Net, load_checkpoint
+
+
+class TorchBackend:
+    """
+    Inference with a torch network. predict_proba takes complexes in the
+    (n, residues, features) layout of the data files and returns probabilities.
+    """
+    def __init__(self, net):
+        self.net = net.eval()
+        # Net already ends with a sigmoid, the other networks return logits
+        self.outputs_probabilities = isinstance(net, Net)
+
+    def predict_proba(self, x):
+        with torch.no_grad():
+            output = self.net(torch.from_numpy(np.ascontiguousarray(np.transpose(x, (0, 2, 1)), dtype=np.float32)))
+            if not self.outputs_probabilities:
+                output = torch.sigmoid(output)
+        return output.numpy().ravel()
+
+def featurize(complexes, embedding="Baseline", keep_energy=True):
+    """
+    Turn raw complexes of an npz partition into model input, like the notebooks do
+    for the whole dataset: Baseline uses them as they are, ESM embeddings re-embed the
+    sequence of every complex and optionally append the energy terms.
+    """
+    if embedding == "Baseline":
+        return np.asarray(complexes, dtype=np.float32)
+
+    import encoding as enc   # loads fair-esm, only needed for ESM embeddings
+    sequences = list(func.extract_sequences(complexes, merge=True))
+    embedded = enc.embed_sequences(sequences, embedding)
+    if keep_energy:
+        embedded = func.add_energy_terms([embedded], [complexes])[0]
+    return np.asarray(embedded, dtype=np.float32)
+
+def iter_npz_chunks(path, chunk_size, key='arr_0'):
+    """
+    Read an array of an npz file chunk_size complexes at a time, without loading the whole
+    array (compressed archives are decompressed as a stream).
+    """
+    with zipfile.ZipFile(path) as archive:
+        with archive.open(key + '.npy') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if fortran_order:
+                raise ValueError("{} is stored in Fortran order and cannot be streamed".format(path))
+            row_size = int(np.prod(shape[1:])) * dtype.itemsize
+            for start in range(0, shape[0], chunk_size):
+                n = min(chunk_size, shape[0] - start)
+                chunk = np.frombuffer(f.read(n * row_size), dtype=dtype).reshape((n,) + tuple(shape[1:]))
+                yield start, chunk
+
+def iter_npy_chunks(path, chunk_size):
+    """
+    Memory-map an .npy file and yield copies of chunk_size complexes at a time.
+    """
+    X = np.load(path, mmap_mode='r')
+    for start in range(0, len(X), chunk_size):
+        yield start, np.array(X[start:start+chunk_size])
+
+class PredictionWriter:
+    """
+    Append prediction chunks to a CSV file, or to a Parquet file (needs pyarrow).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith('.parquet')
+        self.writer = None
+        self.first = True
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode='w' if self.first else 'a', header=self.first, index=False)
+        self.first = False
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def predict_files(predict_fn, inputs, output, featurize_fn=None, chunk_size=256):
+    """
+    Score every complex of the input files chunk by chunk and write the predictions incrementally.
+    predict_fn maps model input to probabilities; chunks of npz partitions (raw complexes) go through
+    featurize_fn first, npy files are taken to hold model input already. Labels next to an npz
+    partition (*labels.npz) are added as a target column. Returns throughput and peak memory.
+    """
+    writer = PredictionWriter(output)
+    n_complexes = 0
+    start = time.time()
+
+    for path in inputs:
+        targets = None
+        raw = path.endswith('.npz')
+        if raw:
+            chunks = iter_npz_chunks(path, chunk_size)
+            if 'input' in os.path.basename(path) and os.path.exists(path.replace("input", "labels")):
+                targets = np.load(path.replace("input", "labels"))["arr_0"]
+        else:
+            chunks = iter_npy_chunks(path, chunk_size)
+
+        for offset, chunk in chunks:
+            probs = predict_fn(featurize_fn(chunk) if raw and featurize_fn is not None else chunk)
+            df = pd.DataFrame({'file': os.path.basename(path),
+                               'index': np.arange(offset, offset + len(chunk)),
+                               'prob': probs,
+                               'pred': np.round(probs).astype(int)})
+            if targets is not None:
+                df['target'] = targets[offset:offset + len(chunk)].astype(int)
+            writer.write(df)
+            n_complexes += len(chunk)
+        print("Scored", path, "-", n_complexes, "complexes so far")
+
+    writer.close()
+    seconds = time.time() - start
+    return {'complexes': n_complexes,
+            'seconds': seconds,
+            'complexes per second': n_complexes / seconds if seconds > 0 else float('nan'),
+            'peak memory MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score complexes with a trained network.")
+    parser.add_argument('--checkpoint', required=True, help="state dict saved during training, or an .onnx export")
+    parser.add_argument('--config', help="JSON file with modelName/embedding/keep_energy, overrides the flags below")
+    parser.add_argument('--model', default="Net_project", help="network class in model.py")
+    parser.add_argument('--embedding', default="Baseline", help="Baseline, esm-1b or esm_ASM")
+    parser.add_argument('--no-energy', action='store_true', help="the network was trained without energy terms")
+    parser.add_argument('--input', nargs='+', required=True, help="npz partitions or npy files of embedded complexes")
+    parser.add_argument('--output', required=True, help=".csv or .parquet")
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--cache', help="SQLite file caching predictions across runs (npz partitions only)")
+    args = parser.parse_args(argv)
+
+    config = {'modelName': args.model, 'embedding': args.embedding, 'keep_energy': not args.no_energy}
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    inputs = sorted(set(fp for pattern in args.input for fp in glob.glob(pattern)))
+    if not inputs:
+        sys.exit("No input files found")
+    if args.cache and not all(fp.endswith('.npz') for fp in inputs):
+        parser.error("--cache needs npz partitions, it is keyed by the raw complexes")
+
+    if args.checkpoint.endswith('.onnx'):
+        from onnx_backend import OnnxBackend
+        backend = OnnxBackend(args.checkpoint, args.threads)
+    else:
+        backend = TorchBackend(load_checkpoint(args.checkpoint, config['modelName']))
+    featurize_fn = lambda chunk: featurize(chunk, config['embedding'], config['keep_energy'])
+    predict_fn = backend.predict_proba
+
+    cache = None
+    if args.cache:
+        from prediction_cache import PredictionCache, checkpoint_id
+        # cache in front of the featurization, so cached complexes are not embedded again
+        model_id = '{}_{}_{}'.format(checkpoint_id(args.checkpoint), config['embedding'], config['keep_energy'])
+        cache = PredictionCache(lambda chunk: backend.predict_proba(featurize_fn(chunk)), model_id, args.cache)
+        predict_fn, featurize_fn = cache.predict_proba, None
+
+    stats = predict_files(predict_fn, inputs, args.output, featurize_fn, chunk_size=args.chunk_size)
+    print("Scored {} complexes in {:.1f} s ({:.1f} complexes/s), peak memory {:.0f} MB".format(
+        stats['complexes'], stats['seconds'], stats['complexes per second'], stats['peak memory MB']))
+    if cache is not None:
+        print("Cache: {}".format(cache.stats()))
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
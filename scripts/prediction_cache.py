@@ -0,0 +1,129 @@
+# Persistent prediction cache.
+#
+# Probabilities are keyed by a hash of the decoded sequences and energy terms of a complex and of the
+# checkpoint that scored it. An in-memory LRU tier sits in front of an on-disk SQLite tier, so repeated
+# complexes are neither embedded nor scored again across runs. PredictionCache wraps any predict_fn
+# taking raw complexes (n, 420, 54), e.g. featurization followed by TorchBackend.predict_proba.
+
+import os
+import hashlib
+import sqlite3
+import collections
+import numpy as np
+
+aminoacids = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+
+
+def checkpoint_id(path):
+    """
+    Content hash of a checkpoint file.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+def complex_key(cmplx, model_id):
+    """
+    Cache key of a raw complex (420 x 54): its decoded sequence, the rows holding residues,
+    its energy terms and the id of the model. Other inputs (e.g. already embedded complexes)
+    are keyed by their raw bytes.
+    """
+    sha = hashlib.sha1(model_id.encode())
+    cmplx = np.asarray(cmplx, dtype=np.float32)
+    if cmplx.shape[-1] == 54:
+        one_hot = cmplx[:, :20]
+        residues = one_hot.max(axis=1) > 0
+        sha.update(''.join(aminoacids[one_hot[residues].argmax(axis=1)]).encode())
+        sha.update(np.packbits(residues).tobytes())
+        sha.update(np.ascontiguousarray(cmplx[:, 20:]).tobytes())
+    else:
+        sha.update(np.ascontiguousarray(cmplx).tobytes())
+    return sha.hexdigest()
+
+class PredictionCache:
+    """
+    Memoize predict_fn per complex. capacity is the number of probabilities kept in memory;
+    path is the SQLite file of the on-disk tier (None for memory only).
+    """
+    def __init__(self, predict_fn, model_id, path=None, capacity=100000):
+        self.predict_fn = predict_fn
+        self.model_id = model_id
+        self.capacity = capacity
+        self.memory = collections.OrderedDict()
+        self.hits = collections.Counter()
+        self.db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, prob REAL)")
+
+    def remember(self, key, prob):
+        self.memory[key] = prob
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def lookup_disk(self, keys):
+        if self.db is None or not keys:
+            return {}
+        found = {}
+        for start in range(0, len(keys), 500):   # stay below SQLite's limit of bound parameters
+            chunk = keys[start:start+500]
+            query = "SELECT key, prob FROM predictions WHERE key IN ({})".format(','.join('?' * len(chunk)))
+            found.update(self.db.execute(query, chunk).fetchall())
+        return found
+
+    def predict_proba(self, complexes):
+        keys = [complex_key(cmplx, self.model_id) for cmplx in complexes]
+        probs = np.empty(len(keys), dtype=np.float32)
+
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                probs[i] = self.memory[key]
+                self.hits['memory'] += 1
+            else:
+                missing.append(i)
+
+        on_disk = self.lookup_disk(list(dict.fromkeys(keys[i] for i in missing)))
+        to_score = []
+        for i in missing:
+            if keys[i] in on_disk:
+                probs[i] = on_disk[keys[i]]
+                self.remember(keys[i], probs[i])
+                self.hits['disk'] += 1
+            else:
+                to_score.append(i)
+
+        if to_score:
+            # identical complexes within the batch are scored once
+            first = {}
+            for i in to_score:
+                first.setdefault(keys[i], i)
+            unique = list(first.values())
+            scored = dict(zip(first, np.asarray(self.predict_fn(np.asarray(complexes)[unique])).ravel()))
+            for i in to_score:
+                probs[i] = scored[keys[i]]
+            for key, prob in scored.items():
+                self.remember(key, float(prob))
+            if self.db is not None:
+                with self.db:
+                    self.db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?)",
+                                        [(key, float(prob)) for key, prob in scored.items()])
+            self.hits['miss'] += len(to_score)
+        return probs
+
+    def stats(self):
+        total = sum(self.hits.values())
+        return {'lookups': total,
+                'memory hits': self.hits['memory'],
+                'disk hits': self.hits['disk'],
+                'misses': self.hits['miss'],
+                'hit rate': (self.hits['memory'] + self.hits['disk']) / total if total else float('nan')}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
@@ -0,0 +1,142 @@
+# Persisted PCA projection of the network input.
+#
+# The projection fitted on the training partitions (functions.fit_pca_store) is saved to an npz file,
+# applied chunk by chunk when a projected partition store is written, and for inference on raw
+# embeddings folded together with bn0 of a network trained on projected input into one layer,
+# so no separate projection step is needed.
+#
+#   python projection.py fit --embedding esm-1b --variance 0.9 --output ../data/PCA_models/esm-1b.npz
+#   python projection.py project --embedding esm-1b --pca ../data/PCA_models/esm-1b.npz
+#   python projection.py fold --checkpoint checkpoint.pt --pca ../data/PCA_models/esm-1b.npz \
+#                             --embedding esm-1b --output net_project_pca.safetensors
+
+import os
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def save_pca(pca, path):
+    """
+    Save a fitted projection (components_, mean_ and optionally explained_variance_ratio_).
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.savez(path, components=pca.components_, mean=pca.mean_,
+             explained_variance_ratio=getattr(pca, 'explained_variance_ratio_', np.array([])),
+             zero_padding=bool(getattr(pca, 'zero_padding', False)))
+
+def load_pca(path):
+    """
+    Load a projection saved by save_pca as a functions.ProjectionPCA.
+    """
+    from functions import ProjectionPCA
+    data = np.load(path)
+    pca = ProjectionPCA(data['components'].astype(np.float32), data['mean'].astype(np.float32),
+                        data['explained_variance_ratio'])
+    pca.zero_padding = bool(data['zero_padding'])
+    return pca
+
+def project_partition_store(store_dir, pca, out_dir, chunk_size=256):
+    """
+    Write the projection of a partition store to a new store, chunk_size complexes at a time.
+    """
+    from functions import load_partition_store
+    X, y, offsets = load_partition_store(store_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    X_out = np.lib.format.open_memmap(os.path.join(out_dir, 'X.npy'), mode='w+', dtype=np.float32,
+                                      shape=(X.shape[0], X.shape[1], pca.n_components_))
+    for start in range(0, len(X), chunk_size):
+        X_out[start:start+chunk_size] = pca.transform(X[start:start+chunk_size])
+    X_out.flush()
+    del X_out
+    np.save(os.path.join(out_dir, 'y.npy'), y)
+    np.save(os.path.join(out_dir, 'offsets.npy'), offsets)
+    return out_dir
+
+class ProjectedInput(nn.Module):
+    """
+    PCA projection followed by bn0 as one layer on raw (n, features, residues) input.
+    Residue positions get W x + bias + shift, all-zero padding positions W x + bias
+    if the projection keeps padding at zero.
+    """
+    def __init__(self, weight, bias, shift, zero_padding):
+        super(ProjectedInput, self).__init__()
+        self.weight = nn.Parameter(weight)
+        self.bias = nn.Parameter(bias)
+        self.register_buffer('shift', shift)
+        self.zero_padding = zero_padding
+
+    def forward(self, x):
+        y = torch.einsum('kd,ndl->nkl', self.weight, x) + self.bias[None, :, None]
+        if self.zero_padding:
+            return y + self.shift[None, :, None] * (x != 0).any(dim=1, keepdim=True)
+        return y + self.shift[None, :, None]
+
+def fold_pca(net, components, mean, zero_padding=True):
+    """
+    Replace bn0 of a network trained on projected input by a ProjectedInput layer, so it takes the raw
+    features. With z = components (x - mean) and bn0(z) = a z + b: W = a components, shift = -W mean.
+    conv1 keeps running on the reduced number of channels.
+    """
+    bn0 = net.bn0
+    components = torch.as_tensor(components, dtype=torch.float32)
+    mean = torch.as_tensor(mean, dtype=torch.float32)
+    if components.shape[0] != bn0.num_features:
+        raise ValueError("The network takes {} features, the projection has {} components".format(
+            bn0.num_features, components.shape[0]))
+    with torch.no_grad():
+        scale = bn0.weight / torch.sqrt(bn0.running_var + bn0.eps)
+        bias = bn0.bias - bn0.running_mean * scale
+        weight = scale[:, None] * components
+        net.bn0 = ProjectedInput(weight, bias, -(weight @ mean), zero_padding)
+    return net.eval()
+
+def main(argv=None):
+    import functions as func
+    parser = argparse.ArgumentParser(description="Fit, apply and fold the PCA projection of the network input.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ['fit', 'project', 'fold']:
+        command = commands.add_parser(name)
+        command.add_argument('--embedding', default="esm-1b", help="Baseline, esm-1b or esm_ASM")
+        command.add_argument('--no-energy', action='store_true', help="without energy terms")
+        command.add_argument('--separated', action='store_true', help="esm_1b_separated inputs")
+    commands.choices['fit'].add_argument('--variance', type=float, default=0.9, help="explained variance to keep")
+    commands.choices['fit'].add_argument('--max-components', type=int, default=100)
+    commands.choices['fit'].add_argument('--train', type=int, nargs='+', default=func.default_config['train_partitions'])
+    commands.choices['fit'].add_argument('--output', required=True, help=".npz file")
+    commands.choices['project'].add_argument('--pca', required=True)
+    commands.choices['fold'].add_argument('--pca', required=True)
+    commands.choices['fold'].add_argument('--checkpoint', required=True, help="network trained on projected input")
+    commands.choices['fold'].add_argument('--model', default="Net_project")
+    commands.choices['fold'].add_argument('--output', required=True, help=".safetensors artifact")
+    args = parser.parse_args(argv)
+
+    if args.command == 'fit':
+        store_dir = func.partition_store(args.embedding, not args.no_energy, args.separated)
+        X, y, offsets = func.load_partition_store(store_dir)
+        pca = func.fit_pca_store(X, offsets, args.train, args.max_components)
+        variances = pca.explained_variance_ratio_.cumsum()
+        n_components = func.components_for_variance(variances, args.variance)
+        pca = pca.truncate(n_components)
+        save_pca(pca, args.output)
+        print("{} components explain {:.3f} of the variance, saved to {}".format(n_components, variances[n_components-1], args.output))
+
+    elif args.command == 'project':
+        pca = load_pca(args.pca)
+        store_dir = func.partition_store(args.embedding, not args.no_energy, args.separated)
+        out_dir = store_dir.rstrip('/') + '_pca_{}'.format(pca.n_components_)
+        project_partition_store(store_dir, pca, out_dir)
+        print("Projected store written to", out_dir)
+
+    else:
+        from artifact import save_artifact
+        from model import load_checkpoint
+        pca = load_pca(args.pca)
+        net = load_checkpoint(args.checkpoint, args.model)
+        save_artifact(args.output, net, args.model, args.embedding, not args.no_energy, args.separated, pca)
+        print("Wrote {}, the projection is folded into bn0 when it is loaded".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
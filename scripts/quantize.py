@@ -0,0 +1,100 @@
+# Post-training dynamic int8 quantization of a trained network.
+#
+# The weights of the nn.LSTM and nn.Linear modules are stored as int8 and the activations are
+# quantized on the fly, which speeds up the recurrent matmuls on CPU. The quantized network is
+# evaluated on the held-out partition next to the fp32 one, saved, and benchmarked.
+#
+#   python quantize.py --checkpoint checkpoint.pt --model Net_project3 --embedding esm-1b \
+#                      --output checkpoint_int8.pt
+
+import copy
+import argparse
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+import functions as func
+from model import build_model, infer_hyperparameters, load_checkpoint
+from export import benchmark_latency
+
+quantized_modules = {nn.LSTM, nn.Linear}
+
+
+def quantize(net):
+    """
+    Copy of a network in eval mode with dynamically quantized int8 LSTM and Linear layers.
+    """
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(net).eval(), quantized_modules, dtype=torch.qint8)
+
+def save_quantized(qnet, path, modelName, hyperparameters):
+    """
+    Save a quantized network with what is needed to rebuild it.
+    """
+    torch.save({'modelName': modelName,
+                'hyperparameters': hyperparameters,
+                'state_dict': qnet.state_dict()}, path)
+
+def load_quantized(path):
+    """
+    Rebuild a network saved by save_quantized: the fp32 network is quantized
+    first so that its modules accept the packed int8 weights.
+    """
+    artifact = torch.load(path, map_location='cpu', weights_only=False)
+    hp = artifact['hyperparameters']
+    net = build_model(artifact['modelName'], hp['n_features'], hp['numHN'], hp['numFilter'], 0.0)
+    qnet = quantize(net)
+    qnet.load_state_dict(artifact['state_dict'])
+    return qnet.eval()
+
+def compare_on_partitions(nets, X, y, offsets, partitions, bat_size=128):
+    """
+    AUC/MCC/ACC of every network of a dict on some partitions of a partition store.
+    """
+    ldr = DataLoader(func.PartitionDataset(X, y, offsets, partitions), batch_size=bat_size, shuffle=False)
+    results = {}
+    for name, net in nets.items():
+        probs, targs = func.predict_proba(net, ldr)
+        results[name] = func.classification_metrics(targs, probs)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dynamic int8 quantization of a trained network.")
+    parser.add_argument('--checkpoint', required=True, help="state dict saved during training")
+    parser.add_argument('--model', default="Net_project", help="network class in model.py")
+    parser.add_argument('--embedding', default="Baseline", help="Baseline, esm-1b or esm_ASM")
+    parser.add_argument('--no-energy', action='store_true', help="the network was trained without energy terms")
+    parser.add_argument('--separated', action='store_true', help="the network was trained on esm_1b_separated inputs")
+    parser.add_argument('--test', type=int, nargs='+', default=func.default_config['test_partitions'], help="held-out partitions")
+    parser.add_argument('--output', default="checkpoint_int8.pt")
+    parser.add_argument('--max-auc-drop', type=float, default=0.01, help="fail if the quantized AUC is lower by more")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32, 128])
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    net = load_checkpoint(args.checkpoint, args.model)
+    qnet = quantize(net)
+
+    store_dir = func.partition_store(args.embedding, not args.no_energy, args.separated)
+    X, y, offsets = func.load_partition_store(store_dir)
+    results = compare_on_partitions({'fp32': net, 'int8': qnet}, X, y, offsets, args.test)
+    for name, metrics in results.items():
+        print("{:5s} test AUC {:.4f}  MCC {:.4f}  ACC {:.4f}".format(name, metrics['AUC'], metrics['MCC'], metrics['ACC']))
+    auc_drop = results['fp32']['AUC'] - results['int8']['AUC']
+    if auc_drop > args.max_auc_drop:
+        raise SystemExit("Quantization lowers the test AUC by {:.4f}, not saving".format(auc_drop))
+
+    save_quantized(qnet, args.output, args.model, infer_hyperparameters(net.state_dict()))
+    print("Saved", args.output)
+
+    example = torch.randn(max(args.batch_sizes), net.bn0.num_features, 420)
+    for batch_size in args.batch_sizes:
+        x = example[:batch_size]
+        fp32, int8 = benchmark_latency(net, x), benchmark_latency(qnet, x)
+        print("batch size {}: fp32 {:.2f} ms, int8 {:.2f} ms ({:.2f}x)".format(
+            batch_size, fp32['median ms'], int8['median ms'], fp32['median ms'] / int8['median ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# Index of the finished runs in mlflow file stores (mlruns directories).
+#
+# The parameters of every finished run are normalized and hashed once, so the grid runners
+# can look up a configuration in constant time and only queue the ones that are missing.
+
+import os
+import json
+import hashlib
+
+
+mlruns_dirs = ['mlruns', '../results_baseline/mlruns']
+
+# mlflow parameter names used by the notebooks -> configuration keys
+param_names = {'embedding': 'embedding',
+               'Hidden Neurons': 'numHN',
+               'filters CNN': 'numFilter',
+               'Dropout rate': 'dropOutRate',
+               'learning rate': 'learning_rate',
+               'Weight decay': 'weight_decay',
+               'esm_1b_separated': 'esm_1b_separated',
+               'model': 'modelName'}
+
+FINISHED = '3'   # mlflow RunStatus.FINISHED
+
+# tag of the runs logged by asha.py, 'stopped' for trials ASHA stopped at a rung, 'completed' otherwise
+asha_status_tag = 'asha status'
+
+
+def normalize_params(config):
+    """
+    Canonical form of the parameters that identify a run. Runs logged before
+    'model' or 'esm_1b_separated' were parameters used Net_project and whole-complex embeddings.
+    """
+    return {'embedding': str(config['embedding']).strip().lower(),
+            'numHN': int(float(config['numHN'])),
+            'numFilter': int(float(config['numFilter'])),
+            'dropOutRate': repr(float(config['dropOutRate'])),
+            'learning_rate': repr(float(config['learning_rate'])),
+            'weight_decay': repr(float(config['weight_decay'])),
+            'esm_1b_separated': str(config.get('esm_1b_separated', False)).strip().lower() == 'true',
+            'modelName': str(config.get('modelName', 'Net_project')).strip()}
+
+def params_hash(config):
+    """
+    Short hash of the normalized parameters.
+    """
+    normalized = json.dumps(normalize_params(config), sort_keys=True)
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+def read_meta(path):
+    """
+    Top-level 'key: value' pairs of an mlflow meta.yaml.
+    """
+    meta = {}
+    with open(path) as f:
+        for line in f:
+            if ':' in line and not line.startswith(' '):
+                key, value = line.split(':', 1)
+                meta[key.strip()] = value.strip().strip("'")
+    return meta
+
+class RunIndex:
+    """
+    Lookup from parameter hash to the finished runs with those parameters,
+    as a list of (experiment name, run id, stopped by ASHA).
+    """
+    def __init__(self, runs=None):
+        self.runs = runs if runs is not None else {}
+
+    @classmethod
+    def scan(cls, roots=mlruns_dirs):
+        """
+        Read every mlruns directory once. Only active runs with status FINISHED count.
+        """
+        index = cls()
+        for root in roots:
+            if not os.path.isdir(root):
+                continue
+            for experiment_id in os.listdir(root):
+                experiment_dir = os.path.join(root, experiment_id)
+                if not os.path.isfile(os.path.join(experiment_dir, 'meta.yaml')):
+                    continue
+                experiment = read_meta(os.path.join(experiment_dir, 'meta.yaml')).get('name', experiment_id)
+                for run_id in os.listdir(experiment_dir):
+                    params_dir = os.path.join(experiment_dir, run_id, 'params')
+                    if not os.path.isdir(params_dir):
+                        continue
+                    meta = read_meta(os.path.join(experiment_dir, run_id, 'meta.yaml'))
+                    if meta.get('status') != FINISHED or meta.get('lifecycle_stage') != 'active':
+                        continue
+                    config = {}
+                    for name in os.listdir(params_dir):
+                        if name in param_names:
+                            with open(os.path.join(params_dir, name)) as f:
+                                config[param_names[name]] = f.read().strip()
+                    stopped_tag = os.path.join(experiment_dir, run_id, 'tags', asha_status_tag)
+                    stopped = False
+                    if os.path.isfile(stopped_tag):
+                        with open(stopped_tag) as f:
+                            stopped = f.read().strip() == 'stopped'
+                    try:
+                        index.add(config, experiment, run_id, stopped)
+                    except (KeyError, ValueError):
+                        # not a run of the hyperparameter notebooks
+                        continue
+        return index
+
+    def add(self, config, experiment, run_id=None, stopped=False):
+        self.runs.setdefault(params_hash(config), []).append((experiment, run_id, stopped))
+
+    def contains(self, config, name_experiment=None, include_stopped=False):
+        """
+        True if a finished run with the same parameters exists (in the given experiment, if any).
+        Trials stopped early by ASHA only count with include_stopped.
+        """
+        runs = [run for run in self.runs.get(params_hash(config), []) if include_stopped or not run[2]]
+        if name_experiment is None:
+            return len(runs) > 0
+        return any(run[0] == name_experiment for run in runs)
+
+    def missing(self, configs, name_experiment=None, include_stopped=False):
+        """
+        The configurations that still have to run.
+        """
+        return [config for config in configs if not self.contains(config, name_experiment, include_stopped)]
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.runs, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            # indexes saved before the stopped flag existed only hold (experiment, run id)
+            return cls({key: [tuple(run) + (False,) * (3 - len(run)) for run in runs] for key, runs in json.load(f).items()})
+
+    def __len__(self):
+        return sum(len(runs) for runs in self.runs.values())
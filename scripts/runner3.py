@@ -2,6 +2,7 @@ import os
 import time
 import papermill as pm
 from datetime import datetime
+from run_index import RunIndex
 
 #initialize
 date = datetime.today().strftime('%Y%m%d')
@@ -25,6 +26,9 @@ dropOutRate = [0.1, 0.2]
 #for ML- flow
 name_experiment = "hyperparameter grid"
 
+#finished runs are skipped
+index = RunIndex.scan()
+print(len(index), 'finished runs in mlruns')
 
 for sep in esm_1b_separated:
     for emb in embedding:
@@ -35,6 +39,11 @@ for sep in esm_1b_separated:
                         for do in dropOutRate:
                             if emb == 'esm_ASM' and sep == True:
                                 continue
+                            elif index.contains({'embedding': emb, 'numHN': nn, 'numFilter': nf, 'dropOutRate': do,
+                                                 'learning_rate': lr, 'weight_decay': wd, 'esm_1b_separated': sep},
+                                                name_experiment):
+                                print("Skipping finished run:", emb, nn, nf, do, lr, wd, sep)
+                                continue
                             else:
                                 notebook_name = '{}_{}_main3_encoding_{}_numHN_{}_filters_{}_dr_{}_lr_{}_wc_{}_separated_{}.ipynb'.format(date, current_time, emb, nn, nf, (int(do*10)), str(lr).replace(".",""), str(wd).replace(".",""), sep)
                                 print("Running:", notebook_name)
@@ -0,0 +1,56 @@
+import os
+import time
+from datetime import datetime
+
+import grid
+import asha
+from run_index import RunIndex
+
+#initialize
+date = datetime.today().strftime('%Y%m%d')
+current_time = time.strftime("%H-%M-%S", time.localtime())
+RESULTSDIR = '../results/'
+
+#hyperparameters, same grid as runner3.py
+esm_1b_separated = [True, False]
+embedding = [ 'esm-1b','esm_ASM']
+numHN = [26, 32, 64]
+numFilter = [50, 100, 200]
+learning_rate=[0.001, 0.0005]
+weight_decay = [0.0001, 0.0005]
+dropOutRate = [0.1, 0.2]
+
+#scheduler
+min_epochs = 5
+eta = 3
+threads_per_worker = 2
+
+#for ML- flow, stopped configurations are logged to their own experiment (asha.stopped_experiment) and count as done on a rerun
+name_experiment = "hyperparameter grid"
+
+
+if __name__ == '__main__':   # the pool workers re-import this module
+
+    try:
+        os.mkdir(RESULTSDIR)
+    except:
+        print(RESULTSDIR + ' directory already exists')
+
+    configs = grid.expand_grid(esm_1b_separated, embedding, numHN, numFilter, learning_rate, weight_decay, dropOutRate)
+    index = RunIndex.scan()
+    print(len(index), 'finished runs in mlruns')
+    configs = index.missing(configs, name_experiment)
+    configs = index.missing(configs, asha.stopped_experiment(name_experiment), include_stopped=True)
+    print("Running", len(configs), "missing configurations")
+    if not configs:
+        raise SystemExit("Nothing to run")
+
+    results, report = asha.run_asha(configs, min_epochs=min_epochs, eta=eta,
+                                    threads_per_worker=threads_per_worker, name_experiment=name_experiment)
+
+    print(results.head(10).to_string())
+    for key, value in report.items():
+        print("{}: {}".format(key, value))
+    results.to_csv(RESULTSDIR + '{}_{}_asha.csv'.format(date, current_time), index=False)
+
+    print(datetime.now())
@@ -0,0 +1,42 @@
+import os
+import time
+from datetime import datetime
+
+import functions as func
+import cross_validation as cv
+
+#initialize
+date = datetime.today().strftime('%Y%m%d')
+current_time = time.strftime("%H-%M-%S", time.localtime())
+STOREDIR = '../data/partitionStore/'
+RESULTSDIR = '../results/'
+
+#hyperparameters
+embedding = 'esm-1b'
+keep_energy = True
+config = {'modelName': 'Net_project',
+          'numHN': 26,
+          'numFilter': 100,
+          'dropOutRate': 0.1,
+          'learning_rate': 0.001,
+          'weight_decay': 0.0001}
+
+
+if __name__ == '__main__':   # the pool workers re-import this module
+
+    try:
+        os.mkdir(RESULTSDIR)
+    except:
+        print(RESULTSDIR + ' directory already exists')
+
+    # embed/load the data once, every fold worker memory-maps the same copy
+    store_dir = func.partition_store(embedding, keep_energy, store_root=STOREDIR)
+
+    results, summary = cv.cross_validate(store_dir, config)
+
+    print(results.to_string(index=False))
+    print("\n", summary)
+    results.to_csv(RESULTSDIR + '{}_{}_cv_emb_{}_HN_{}_nFilt_{}_do_{}_energy_{}.csv'.format(
+        date, current_time, embedding, config['numHN'], config['numFilter'], int(config['dropOutRate']*10), keep_energy), index=False)
+
+    print(datetime.now())
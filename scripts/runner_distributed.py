@@ -0,0 +1,72 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+import functions as func
+import distributed
+
+#initialize
+date = datetime.today().strftime('%Y%m%d')
+current_time = time.strftime("%H-%M-%S", time.localtime())
+STOREDIR = '../data/partitionStore/'
+RESULTSDIR = '../results/'
+
+#benchmark settings
+embedding = 'Baseline'
+workers = [1, 2, 4, 8]
+epochs = 3
+config = {'modelName': 'Net_project',
+          'numHN': 26,
+          'numFilter': 100,
+          'dropOutRate': 0.1,
+          'epochs': epochs,
+          'patience': epochs + 1,
+          'checkpoint': None}
+
+
+if __name__ == '__main__':   # mp.spawn re-imports this module in every worker
+
+    try:
+        os.mkdir(RESULTSDIR)
+    except:
+        print(RESULTSDIR + ' directory already exists')
+
+    store_dir = STOREDIR + embedding
+    if not os.path.exists(os.path.join(store_dir, 'X.npy')):
+        data_list, target_list = func.load_partitions()
+        if embedding == 'Baseline' and len(data_list) == 5:
+            print('Writing partition store to', store_dir)
+            func.save_partition_store(data_list, target_list, store_dir)
+        else:
+            # random complexes with the partition sizes and shape of the baseline data
+            print(store_dir, 'not found, benchmarking on synthetic data')
+            store_dir = STOREDIR + 'synthetic'
+            rng = np.random.default_rng(42)
+            sizes = [1480, 1532, 1168, 1526, 1207]
+            data_list = [rng.standard_normal((n, 420, 54), dtype=np.float32) for n in sizes]
+            target_list = [rng.integers(0, 2, n).astype(np.float32) for n in sizes]
+            func.save_partition_store(data_list, target_list, store_dir)
+
+    rows = []
+    for n_workers in workers:
+        print('Running with {} worker(s)'.format(n_workers))
+        history = distributed.train_distributed(store_dir, config, world_size=n_workers,
+                                                result_path='distributed_history_{}.pkl'.format(n_workers))
+        # the first epoch includes process start-up and page faults of the memory map
+        epoch_time = np.mean(history['epoch_times'][1:]) if len(history['epoch_times']) > 1 else history['epoch_times'][0]
+        rows.append({'workers': n_workers,
+                     'seconds_per_epoch': epoch_time,
+                     'complexes_per_second': history['n_train'] / epoch_time,
+                     'valid_auc': history['valid_auc'][-1],
+                     'test_auc': history['test_auc']})
+        os.remove('distributed_history_{}.pkl'.format(n_workers))
+
+    results = pd.DataFrame(rows)
+    results['speedup'] = results['seconds_per_epoch'].iloc[0] / results['seconds_per_epoch']
+    results['efficiency'] = results['speedup'] / results['workers']
+    print(results.to_string(index=False))
+    results.to_csv(RESULTSDIR + '{}_{}_distributed_scaling_{}.csv'.format(date, current_time, embedding), index=False)
+
+    print(datetime.now())
@@ -0,0 +1,47 @@
+import os
+import time
+from datetime import datetime
+
+import grid
+from run_index import RunIndex
+
+#initialize
+date = datetime.today().strftime('%Y%m%d')
+current_time = time.strftime("%H-%M-%S", time.localtime())
+RESULTSDIR = '../results/'
+
+#hyperparameters, same grid as runner3.py
+esm_1b_separated = [True, False]
+embedding = [ 'esm-1b','esm_ASM']
+numHN = [26, 32, 64]
+numFilter = [50, 100, 200]
+learning_rate=[0.001, 0.0005]
+weight_decay = [0.0001, 0.0005]
+dropOutRate = [0.1, 0.2]
+
+#workers
+threads_per_worker = 2
+
+#for ML- flow
+name_experiment = "hyperparameter grid"
+
+
+if __name__ == '__main__':   # the pool workers re-import this module
+
+    try:
+        os.mkdir(RESULTSDIR)
+    except:
+        print(RESULTSDIR + ' directory already exists')
+
+    configs = grid.expand_grid(esm_1b_separated, embedding, numHN, numFilter, learning_rate, weight_decay, dropOutRate)
+    index = RunIndex.scan()
+    print(len(index), 'finished runs in mlruns')
+    configs = index.missing(configs, name_experiment)
+    print("Running", len(configs), "missing configurations")
+    if not configs:
+        raise SystemExit("Nothing to run")
+
+    results = grid.run_grid(configs, threads_per_worker=threads_per_worker, name_experiment=name_experiment)
+    results.to_csv(RESULTSDIR + '{}_{}_grid.csv'.format(date, current_time), index=False)
+
+    print(datetime.now())
@@ -0,0 +1,196 @@
+# Library screening: one TCR against many peptides on a fixed MHC, or one pMHC against a TCR repertoire.
+#
+# With the default separated layout, every chain is embedded on its own like in encode_separately_MSA.ipynb:
+# the fixed chains once, the varying chain in batches. Each complex is assembled from the chain
+# embeddings in the notebook's row layout and the complexes are scored in large batches. All scores are
+# streamed to the output file and the ranked top-k is written at the end.
+#
+#   python screening.py --checkpoint separated_no_energy.pt --embedding esm_ASM --mhc MHCSEQ --tcr TCRSEQ \
+#                       --vary peptide --candidates peptides.txt --output scores.csv --top-k 100
+#
+# New complexes have no energy terms, so the network must take the embeddings only: with the separated
+# layout a network trained on the separated chains without their energy columns, with --layout complex a
+# network trained on whole-complex embeddings without energy terms (keep_energy False). The complex
+# layout embeds the whole MHC+peptide+TCR sequence of every candidate like encoder.py, so nothing is
+# reused between candidates.
+
+import heapq
+import argparse
+import numpy as np
+import pandas as pd
+
+from model import load_checkpoint
+from predict import TorchBackend, PredictionWriter
+
+n_residues = 420
+chain_order = ['MHC', 'peptide', 'tcr']
+# rows of the MHC block and of the peptide slot (peptide and its padding) in the data files
+mhc_rows = 179
+peptide_slot = (179, 192)
+# longest peptide of the data files and smallest peptide block of encode_separately_MSA.ipynb
+max_peptide = 11
+min_peptide_rows = 9
+
+
+def tcr_offset(peptide_length):
+    """
+    First TCR row of the separated layout. The notebook writes the peptide block with at least 9 rows,
+    followed by the padding the peptide had in the data files, so the TCR starts at row 192 unless the
+    peptide is shorter than 9 residues.
+    """
+    return peptide_slot[1] + max(0, min_peptide_rows - peptide_length)
+
+class ChainEmbedder:
+    """
+    Separated layout: per-residue embeddings of single chains (without padding), cached by sequence,
+    assembled into complexes at the rows of encode_separately_MSA.ipynb.
+    """
+    def __init__(self, embedding, batch_size=8):
+        self.embedding = embedding
+        self.batch_size = batch_size
+        self.cache = {}
+
+    def embed(self, sequences):
+        import encoding as enc   # loads fair-esm
+        missing = list(dict.fromkeys(seq for seq in sequences if seq not in self.cache))
+        if missing:
+            for seq, emb in zip(missing, enc.embed_sequences(missing, self.embedding, self.batch_size, pad_to=None)):
+                self.cache[seq] = emb
+        return [self.cache[seq] for seq in sequences]
+
+    def check(self, chains):
+        if len(chains['MHC']) > mhc_rows:
+            raise ValueError("MHC sequence of length {} does not fit in its {} rows".format(len(chains['MHC']), mhc_rows))
+        if len(chains['peptide']) > max_peptide:
+            raise ValueError("peptide of length {} is longer than {}".format(len(chains['peptide']), max_peptide))
+        tcr_rows = n_residues - tcr_offset(len(chains['peptide']))
+        if len(chains['tcr']) > tcr_rows:
+            raise ValueError("TCR sequence of length {} does not fit in its {} rows".format(len(chains['tcr']), tcr_rows))
+
+    def complexes(self, fixed, vary, batch):
+        """
+        (n, 420, d) model input of the fixed chains with every sequence of batch as the varying chain.
+        """
+        fixed_embeddings = dict(zip(fixed, self.embed(list(fixed.values()))))
+        varying = self.embed(batch)
+        out = np.zeros((len(batch), n_residues, varying[0].shape[1]), dtype=np.float32)
+        for cmplx, emb in zip(out, varying):
+            chains = dict(fixed_embeddings, **{vary: emb})
+            offsets = {'MHC': 0, 'peptide': peptide_slot[0], 'tcr': tcr_offset(len(chains['peptide']))}
+            for chain, chain_emb in chains.items():
+                cmplx[offsets[chain]:offsets[chain] + len(chain_emb)] = chain_emb
+        # embeddings of the varying chain are not reused within a screen
+        self.cache = {s: e for s, e in self.cache.items() if s in fixed.values()}
+        return out
+
+class ComplexEmbedder:
+    """
+    Complex layout: the whole MHC+peptide+TCR sequence of every complex embedded in one pass and
+    padded to 420 rows, like encoder.py.
+    """
+    def __init__(self, embedding, batch_size=8):
+        self.embedding = embedding
+        self.batch_size = batch_size
+
+    def check(self, chains):
+        length = sum(len(chains[chain]) for chain in chain_order)
+        if length > n_residues:
+            raise ValueError("complex of length {} does not fit in {} rows".format(length, n_residues))
+
+    def complexes(self, fixed, vary, batch):
+        import encoding as enc   # loads fair-esm
+        sequences = [''.join(dict(fixed, **{vary: seq})[chain] for chain in chain_order) for seq in batch]
+        return np.asarray(enc.embed_sequences(sequences, self.embedding, self.batch_size), dtype=np.float32)
+
+layouts = {'separated': ChainEmbedder, 'complex': ComplexEmbedder}
+
+def iter_candidates(path):
+    """
+    Sequences of a candidates file, one per line (or the first column of a CSV).
+    """
+    with open(path) as f:
+        for line in f:
+            seq = line.strip().split(',')[0]
+            if seq and seq.isalpha():
+                yield seq
+
+def screen(predict_fn, embedder, fixed, vary, candidates, output, batch_size=256, top_k=100, n_features=None):
+    """
+    Score the complexes made of the fixed chains (dict chain -> sequence) and every candidate
+    sequence of the varying chain, assembled by embedder (ChainEmbedder or ComplexEmbedder).
+    Scores are appended to output as they are computed; returns the top_k candidates as a
+    DataFrame ranked by probability. n_features, if given, is checked against the first batch.
+    """
+    if vary in fixed:
+        raise ValueError("{} cannot be both fixed and varying".format(vary))
+
+    writer = PredictionWriter(output)
+    top = []   # min-heap of (prob, index, sequence)
+    index = 0
+    batch = []
+    candidates = iter(candidates)
+    while True:
+        seq = next(candidates, None)
+        if seq is not None:
+            embedder.check(dict(fixed, **{vary: seq}))
+            batch.append(seq)
+        if batch and (seq is None or len(batch) == batch_size):
+            complexes = embedder.complexes(fixed, vary, batch)
+            if n_features is not None and complexes.shape[2] != n_features:
+                raise ValueError("The network takes {} features but the {} embedding has {}; energy terms are "
+                                 "not available for new complexes".format(n_features, embedder.embedding, complexes.shape[2]))
+            probs = predict_fn(complexes)
+            writer.write(pd.DataFrame({'index': np.arange(index, index + len(batch)), vary: batch, 'prob': probs}))
+            for i, (s, p) in enumerate(zip(batch, probs)):
+                item = (float(p), index + i, s)
+                if len(top) < top_k:
+                    heapq.heappush(top, item)
+                elif item > top[0]:
+                    heapq.heapreplace(top, item)
+            index += len(batch)
+            batch = []
+        if seq is None:
+            break
+    writer.close()
+
+    ranked = sorted(top, reverse=True)
+    return pd.DataFrame({'rank': np.arange(1, len(ranked) + 1),
+                         'index': [i for _, i, _ in ranked],
+                         vary: [s for _, _, s in ranked],
+                         'prob': [p for p, _, _ in ranked]})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Screen a library of peptides or TCRs against fixed chains.")
+    parser.add_argument('--checkpoint', required=True, help="network trained on embeddings without energy terms")
+    parser.add_argument('--model', default="Net_project", help="network class in model.py")
+    parser.add_argument('--embedding', default="esm-1b", help="esm-1b or esm_ASM")
+    parser.add_argument('--layout', choices=sorted(layouts), default='separated',
+                        help="separately embedded chains (fixed chains embedded once) or whole-complex embeddings")
+    parser.add_argument('--mhc', help="MHC sequence")
+    parser.add_argument('--peptide', help="peptide sequence (when screening TCRs)")
+    parser.add_argument('--tcr', help="TCR sequence (when screening peptides)")
+    parser.add_argument('--vary', choices=['peptide', 'tcr'], required=True, help="chain taken from the candidates file")
+    parser.add_argument('--candidates', required=True, help="one sequence per line")
+    parser.add_argument('--output', required=True, help="all scores, .csv or .parquet")
+    parser.add_argument('--top-k', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=256, help="complexes scored per batch")
+    parser.add_argument('--embedding-batch-size', type=int, default=8, help="sequences per ESM forward pass")
+    args = parser.parse_args(argv)
+
+    fixed = {'MHC': args.mhc, 'peptide': args.peptide, 'tcr': args.tcr}
+    fixed = {chain: seq for chain, seq in fixed.items() if chain != args.vary}
+    if any(seq is None for seq in fixed.values()):
+        parser.error("every chain except --vary needs a sequence")
+
+    net = load_checkpoint(args.checkpoint, args.model)
+    embedder = layouts[args.layout](args.embedding, args.embedding_batch_size)
+    top = screen(TorchBackend(net).predict_proba, embedder, fixed, args.vary, iter_candidates(args.candidates),
+                 args.output, args.batch_size, args.top_k, n_features=net.bn0.num_features)
+    top_path = args.output.rsplit('.', 1)[0] + '_top{}.csv'.format(args.top_k)
+    top.to_csv(top_path, index=False)
+    print("Scored candidates written to {}, top {} to {}".format(args.output, len(top), top_path))
+    print(top.head(10).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
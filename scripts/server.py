@@ -0,0 +1,263 @@
+# Local HTTP inference server with dynamic micro-batching.
+#
+# Request handler threads put the complexes of each request on a queue; one batching thread
+# coalesces queued requests into a micro-batch until it is full or the oldest request has waited
+# max_latency_ms, and runs it through the single shared model.
+#
+#   python server.py --checkpoint checkpoint.pt --model Net_project --port 8000
+#   python server.py --load-test http://127.0.0.1:8000      (from another shell)
+#
+# POST /predict   JSON {"complexes": [...]} (n x residues x features) or an .npy body
+#                 (Content-Type: application/octet-stream); returns {"probabilities": [...]}
+# GET  /metrics   latency percentiles and batch size histogram
+# GET  /health
+
+import io
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+
+from model import load_checkpoint
+from predict import TorchBackend, featurize
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent requests into batches for predict_fn, which maps an
+    (n, residues, features) array to n probabilities. Requests whose complexes are not
+    (residues x n_features) are rejected in submit, so they never reach a batch.
+    """
+    def __init__(self, predict_fn, max_batch_size=64, max_latency_ms=10, history=10000, n_features=None, n_residues=420):
+        self.predict_fn = predict_fn
+        self.n_features = n_features
+        self.n_residues = n_residues
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=history)
+        self.batch_sizes = collections.Counter()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, complexes):
+        """
+        Queue the complexes of one request, returns a Future of their probabilities.
+        """
+        complexes = np.asarray(complexes, dtype=np.float32)
+        expected = (self.n_residues, self.n_features)
+        if complexes.ndim != 3 or len(complexes) == 0 or any(
+                size is not None and actual != size for actual, size in zip(complexes.shape[1:], expected)):
+            raise ValueError("expected complexes of shape (n, {}, {}), got {}".format(
+                self.n_residues, self.n_features, complexes.shape))
+        future = Future()
+        self.requests.put((time.time(), complexes, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            n = len(batch[0][1])
+            deadline = batch[0][0] + self.max_latency
+            # requests that queued up while the last batch ran join without waiting, even if the
+            # oldest one is already past its deadline
+            while n < self.max_batch_size:
+                try:
+                    item = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                n += len(item[1])
+            while n < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                n += len(item[1])
+
+            try:
+                probs = self.predict_fn(np.concatenate([complexes for _, complexes, _ in batch]))
+            except Exception:
+                # run the requests one by one, so only the failing ones get the error
+                self.run_separately(batch)
+                continue
+
+            done = time.time()
+            start = 0
+            with self.lock:
+                self.batch_sizes[n] += 1
+                for arrival, complexes, future in batch:
+                    future.set_result(probs[start:start + len(complexes)])
+                    start += len(complexes)
+                    self.latencies.append(done - arrival)
+
+    def run_separately(self, batch):
+        for arrival, complexes, future in batch:
+            try:
+                probs = self.predict_fn(complexes)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            with self.lock:
+                self.batch_sizes[len(complexes)] += 1
+                self.latencies.append(time.time() - arrival)
+            future.set_result(probs)
+
+    def stats(self):
+        """
+        Latency percentiles (ms) of the last requests and histogram of batch sizes (in complexes).
+        """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = dict(self.batch_sizes)
+        histogram = collections.Counter()
+        for size, count in batch_sizes.items():
+            histogram[1 << (size - 1).bit_length()] += count   # bucket by the next power of two
+        return {'requests': len(latencies),
+                'p50 latency ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99 latency ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'batches': sum(batch_sizes.values()),
+                'mean batch size': (sum(size * count for size, count in batch_sizes.items()) / sum(batch_sizes.values())
+                                    if batch_sizes else None),
+                'batch size histogram': {'<={}'.format(bucket): histogram[bucket] for bucket in sorted(histogram)}}
+
+def make_handler(batcher, featurize_fn=None):
+    """
+    Request handler class bound to a batcher. featurize_fn turns raw complexes into model input.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send_json(200, batcher.stats())
+            elif self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            else:
+                self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type') == 'application/octet-stream':
+                    complexes = np.load(io.BytesIO(body))
+                else:
+                    complexes = np.asarray(json.loads(body)['complexes'], dtype=np.float32)
+                if complexes.ndim == 2:
+                    complexes = complexes[None]
+                if featurize_fn is not None:
+                    complexes = featurize_fn(complexes)
+                probs = batcher.submit(complexes).result()
+            except (ValueError, KeyError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            except Exception as e:
+                self.send_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+                return
+            self.send_json(200, {'probabilities': [float(p) for p in probs]})
+
+        def log_message(self, format, *args):
+            pass   # one line per request would dominate the latency
+
+    return Handler
+
+def serve(predict_fn, host='127.0.0.1', port=8000, max_batch_size=64, max_latency_ms=10, featurize_fn=None, n_features=None):
+    """
+    Start the server (blocking). Only binds to localhost by default.
+    """
+    batcher = MicroBatcher(predict_fn, max_batch_size, max_latency_ms, n_features=n_features)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, featurize_fn))
+    print("Serving on http://{}:{}".format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def load_test(url, n_requests=1000, concurrency=32, complexes_per_request=1, n_features=54):
+    """
+    Send random complexes from concurrent clients and print client latencies
+    and the server's /metrics.
+    """
+    rng = np.random.default_rng(42)
+    payloads = []
+    for _ in range(min(n_requests, 32)):
+        buffer = io.BytesIO()
+        np.save(buffer, rng.standard_normal((complexes_per_request, 420, n_features), dtype=np.float32))
+        payloads.append(buffer.getvalue())
+
+    def request(i):
+        start = time.time()
+        req = urllib.request.Request(url + '/predict', data=payloads[i % len(payloads)],
+                                     headers={'Content-Type': 'application/octet-stream'})
+        with urllib.request.urlopen(req) as response:
+            json.loads(response.read())
+        return time.time() - start
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = np.array(list(pool.map(request, range(n_requests)))) * 1000
+    seconds = time.time() - start
+
+    print("{} requests in {:.1f} s ({:.1f} complexes/s)".format(n_requests, seconds, n_requests * complexes_per_request / seconds))
+    print("client p50 {:.1f} ms, p99 {:.1f} ms".format(np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    with urllib.request.urlopen(url + '/metrics') as response:
+        print(json.dumps(json.loads(response.read()), indent=2))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP inference server with micro-batching.")
+    parser.add_argument('--checkpoint', help="state dict saved during training")
+    parser.add_argument('--model', default="Net_project", help="network class in model.py")
+    parser.add_argument('--embedding', default="Baseline", help="Baseline, esm-1b or esm_ASM")
+    parser.add_argument('--no-energy', action='store_true', help="the network was trained without energy terms")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-latency-ms', type=float, default=10)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--load-test', metavar='URL', help="run the load test against a running server instead")
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args(argv)
+
+    if args.load_test:
+        load_test(args.load_test, args.requests, args.concurrency)
+        return
+    if not args.checkpoint:
+        parser.error("--checkpoint is required to serve")
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    backend = TorchBackend(load_checkpoint(args.checkpoint, args.model))
+    featurize_fn = None
+    if args.embedding != "Baseline":
+        from encoding import load_esm
+        # load the ESM model before the first request instead of in a handler thread
+        load_esm(args.embedding)
+        featurize_fn = lambda complexes: featurize(complexes, args.embedding, not args.no_energy)
+    serve(backend.predict_proba, args.host, args.port, args.max_batch_size, args.max_latency_ms, featurize_fn,
+          n_features=backend.net.bn0.num_features)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+# The vectorized ensemble gives the outputs of a loop over its networks.
+#
+#   python -m pytest test_ensemble.py
+
+import pytest
+import torch
+
+from model import build_model
+from ensemble import StackedEnsemble
+
+
+def random_nets(modelName, k=3, n_features=54):
+    nets = []
+    for seed in range(k):
+        torch.manual_seed(seed)
+        net = build_model(modelName, n_features, 16, 20, 0.0)
+        # non-trivial running statistics, so the BatchNorms are exercised too
+        for module in net.modules():
+            if isinstance(module, torch.nn.BatchNorm1d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 1.5)
+        nets.append(net.eval())
+    return nets
+
+@pytest.mark.parametrize('modelName', ['Net', 'Net_project', 'Net_project3', 'Net_project4'])
+def test_vectorized_matches_loop(modelName):
+    nets = random_nets(modelName)
+    x = torch.randn(5, 54, 420)
+    ensemble = StackedEnsemble(nets)
+    vectorized = ensemble.forward(x)
+    with torch.no_grad():
+        looped = torch.stack([net(x).reshape(-1) for net in nets])
+    if not ensemble.outputs_probabilities:
+        looped = torch.sigmoid(looped)
+    assert vectorized.shape == (len(nets), len(x))
+    torch.testing.assert_close(vectorized, looped, atol=1e-5, rtol=1e-4)
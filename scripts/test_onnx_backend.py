@@ -0,0 +1,30 @@
+# The ONNX export of every exportable network gives the probabilities of the torch network.
+#
+#   python -m pytest test_onnx_backend.py
+
+import pytest
+import torch
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from model import Net, build_model
+from predict import TorchBackend
+from onnx_backend import export_onnx, OnnxBackend, parity_suite, min_length, exportable
+
+
+@pytest.mark.parametrize('modelName', exportable)
+def test_onnx_parity(modelName, tmp_path):
+    torch.manual_seed(0)
+    net = build_model(modelName, 54, numHN=16, numFilter=20, dropOutRate=0.0).eval()
+    path = export_onnx(net, str(tmp_path / '{}.onnx'.format(modelName)), 54)
+    # raises on any case above atol, including the shorter lengths of the dynamic residues axis
+    parity_suite(TorchBackend(net), OnnxBackend(path), 54, isinstance(net, Net), batch_sizes=(1, 7))
+
+def test_min_length():
+    net = build_model('Net_project3', 54, numHN=16, numFilter=20, dropOutRate=0.0).eval()
+    shortest = min_length(net, 54)
+    with torch.no_grad():
+        net(torch.zeros(1, 54, shortest))
+        with pytest.raises(RuntimeError):
+            net(torch.zeros(1, 54, shortest - 1))